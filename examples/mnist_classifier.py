@@ -3,7 +3,6 @@
 import time
 
 import jax.numpy as np
-import numpy.random as npr
 from jax.nn import relu, log_softmax
 from jax.random import PRNGKey
 
@@ -51,27 +50,18 @@ def main():
     num_epochs = 10
     batch_size = 128
     train_images, train_labels, test_images, test_labels = mnist()
-    num_train = train_images.shape[0]
-    num_complete_batches, leftover = divmod(num_train, batch_size)
-    num_batches = num_complete_batches + bool(leftover)
-
-    def data_stream():
-        rng = npr.RandomState(0)
-        while True:
-            perm = rng.permutation(num_train)
-            for i in range(num_batches):
-                batch_idx = perm[i * batch_size:(i + 1) * batch_size]
-                yield train_images[batch_idx], train_labels[batch_idx]
-
-    batches = data_stream()
+    num_batches = train_images.shape[0] // batch_size
 
     opt = optimizers.Momentum(0.001, mass=0.9)
-    state = opt.init(loss.init_parameters(*next(batches)), key=PRNGKey(0))
+    state = opt.init(loss.init_parameters(train_images[:batch_size], train_labels[:batch_size],
+                                          key=PRNGKey(0)))
 
     for epoch in range(num_epochs):
         start_time = time.time()
-        for _ in range(num_batches):
-            state = opt.update(loss.apply, state, *next(batches), jit=True)
+        # runs the whole epoch (including shuffling and batching) on device:
+        state, _ = opt.update_many(loss.apply, state, (train_images, train_labels),
+                                   num_steps=num_batches, batch_size=batch_size,
+                                   key=PRNGKey(epoch))
         epoch_time = time.time() - start_time
 
         params = opt.get_parameters(state)
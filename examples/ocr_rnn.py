@@ -4,7 +4,7 @@ from jax import numpy as np, random
 from jax.nn import softmax
 from jax.random import PRNGKey
 
-from jaxnet import Sequential, Rnn, Dense, GRUCell, parametrized, optimizers
+from jaxnet import Sequential, StackedRnn, Dense, FusedGRUCell, parametrized, optimizers
 
 
 def read_dataset():
@@ -22,14 +22,12 @@ def main():
     carry_size = 200
     batch_size = 10
 
-    def rnn():
-        return Rnn(*GRUCell(carry_size=carry_size,
-                            param_init=lambda key, shape: random.normal(key, shape) * 0.01))
+    def cell():
+        return FusedGRUCell(carry_size=carry_size,
+                            param_init=lambda key, shape: random.normal(key, shape) * 0.01)
 
     net = Sequential(
-        rnn(),
-        rnn(),
-        rnn(),
+        StackedRnn(cell(), cell(), cell()),  # all layers run in a single scan
         lambda x: np.reshape(x, (-1, carry_size)),  # -> same weights for all time steps
         Dense(out_dim=class_count),
         softmax,
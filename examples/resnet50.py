@@ -1,25 +1,26 @@
 # Run this example in your browser: https://colab.research.google.com/drive/1q6yoK_Zscv-57ZzPM4qNy3LgjeFzJ5xN#scrollTo=p0J1g94IpxK-
 
 import numpy.random as npr
-from jax import numpy as np
+from jax import numpy as np, partial
 from jax.nn import relu, log_softmax
 from jax.random import PRNGKey
 
 from jaxnet import Conv, BatchNorm, GeneralConv, MaxPool, Dense, AvgPool, flatten, \
-    Sequential, parametrized, optimizers
+    Sequential, parametrized, optimizers, fold_batch_norm
 
 
 def ConvBlock(kernel_size, filters, strides=(2, 2)):
     ks = kernel_size
     filters1, filters2, filters3 = filters
+    Norm = partial(BatchNorm, momentum=.9)
 
     @parametrized
     def conv_block(inputs):
         main = Sequential(
-            Conv(filters1, (1, 1), strides), BatchNorm(), relu,
-            Conv(filters2, (ks, ks), padding='SAME'), BatchNorm(), relu,
-            Conv(filters3, (1, 1)), BatchNorm())
-        shortcut = Sequential(Conv(filters3, (1, 1), strides), BatchNorm())
+            Conv(filters1, (1, 1), strides), Norm(), relu,
+            Conv(filters2, (ks, ks), padding='SAME'), Norm(), relu,
+            Conv(filters3, (1, 1)), Norm())
+        shortcut = Sequential(Conv(filters3, (1, 1), strides), Norm())
         return relu(sum((main(inputs), shortcut(inputs))))
 
     return conv_block
@@ -28,13 +29,14 @@ def ConvBlock(kernel_size, filters, strides=(2, 2)):
 def IdentityBlock(kernel_size, filters):
     ks = kernel_size
     filters1, filters2 = filters
+    Norm = partial(BatchNorm, momentum=.9)
 
     @parametrized
     def identity_block(inputs):
         main = Sequential(
-            Conv(filters1, (1, 1)), BatchNorm(), relu,
-            Conv(filters2, (ks, ks), padding='SAME'), BatchNorm(), relu,
-            Conv(inputs.shape[3], (1, 1)), BatchNorm())
+            Conv(filters1, (1, 1)), Norm(), relu,
+            Conv(filters2, (ks, ks), padding='SAME'), Norm(), relu,
+            Conv(inputs.shape[3], (1, 1)), Norm())
 
         return relu(sum((main(inputs), inputs)))
 
@@ -44,7 +46,7 @@ def IdentityBlock(kernel_size, filters):
 def ResNet50(num_classes):
     return Sequential(
         GeneralConv(('HWCN', 'OIHW', 'NHWC'), 64, (7, 7), (2, 2), 'SAME'),
-        BatchNorm(), relu, MaxPool((3, 3), strides=(2, 2)),
+        BatchNorm(momentum=.9), relu, MaxPool((3, 3), strides=(2, 2)),
         ConvBlock(3, [64, 64, 256], strides=(1, 1)),
         IdentityBlock(3, [64, 64]),
         IdentityBlock(3, [64, 64]),
@@ -104,6 +106,12 @@ def main():
         state = opt.update(loss.apply, state, *next(batches))
     trained_params = opt.get_parameters(state)
 
+    # batch norm with running statistics, folded into convolutions,
+    # i. e. for predictions on single examples:
+    predict = fold_batch_norm(resnet, trained_params.sequential)
+    images, _ = next(batches)
+    predict(images[..., :1])
+
 
 if __name__ == '__main__':
     main()
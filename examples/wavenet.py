@@ -5,7 +5,7 @@ from jax.nn import sigmoid, softplus, log_softmax, relu
 from jax.random import PRNGKey
 from jax.scipy.special import logsumexp
 
-from jaxnet import Sequential, parametrized, Conv1D, L2Regularized, optimizers
+from jaxnet import Sequential, parametrized, Conv1D, optimizers
 
 
 def discretized_mix_logistic_loss(theta, y, num_class=256, log_scale_min=-7.):
@@ -165,9 +165,10 @@ def main():
             theta, sliced_batch, num_class=1 << 16), axis=0)
                 * np.log2(np.e) / (output_width - 1))
 
-    loss = L2Regularized(loss, .01)
-
-    opt = optimizers.Adam(optimizers.exponential_decay(1e-3, decay_steps=1, decay_rate=0.999995))
+    # decoupled weight decay (scaled by the step size), avoiding an additional pass over all
+    # weights as in L2Regularized:
+    opt = optimizers.Adam(optimizers.exponential_decay(1e-3, decay_steps=1, decay_rate=0.999995),
+                          weight_decay=.01)
     print(f'Initializing parameters.')
     state = opt.init(loss.init_parameters(next(batches), key=PRNGKey(0)))
     for batch in batches:
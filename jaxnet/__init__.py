@@ -1,2 +1,2 @@
-from jaxnet.core import parametrized, Parameter, save, load
+from jaxnet.core import parametrized, Parameter, save, load, load_exported, updated_parameters
 from jaxnet.modules import *
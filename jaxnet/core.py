@@ -1,3 +1,5 @@
+import pickle
+import sys
 from collections import namedtuple, Counter, defaultdict
 from functools import lru_cache
 from pathlib import Path
@@ -5,11 +7,14 @@ from typing import Iterable
 
 import dill
 import jax
+import numpy as onp
 from jax import lax, random, unzip2, safe_zip, safe_map, partial, raise_to_shaped, tree_flatten, \
-    tree_unflatten, flatten_fun_nokwargs, jit, curry
+    tree_unflatten, tree_structure, flatten_fun_nokwargs, jit, curry, vmap
 from jax.abstract_arrays import ShapedArray
 from jax.core import new_master, cur_sublevel, Tracer, Trace, Primitive, get_aval, unit, \
-    TypedJaxpr, MasterTrace, full_lower, valid_jaxtype, trace_state, find_top_trace
+    TypedJaxpr, MasterTrace, full_lower, valid_jaxtype, trace_state, find_top_trace, Literal, \
+    unitvar, eval_jaxpr, Jaxpr
+from jax.interpreters import xla
 from jax.interpreters.partial_eval import trace_to_jaxpr, PartialVal, closure_convert_jaxpr
 from jax.lax.lax_control_flow import _index_array, scan_p, _abstractify, _scan_impl
 from jax.linear_util import wrap_init, transformation, transformation_with_aux
@@ -65,6 +70,67 @@ def random_key():
     return random_key_p.bind()
 
 
+def _update_parameter_impl(*args, **params):
+    assert len(args) == 2
+    assert len(params) == 0
+
+    return []
+
+
+update_parameter_p = Primitive("update_parameter")
+update_parameter_p.multiple_results = True
+update_parameter_p.def_custom_bind(bind(update_parameter_p))
+update_parameter_p.def_impl(_update_parameter_impl)
+update_parameter_p.def_abstract_eval(_update_parameter_impl)
+
+# Stack of updates by position of the updated parameter, see `updating_parameters`:
+_parameter_updates = []
+
+
+def _trace_context():
+    """State of the trace stack, apart from apply traces. Differs from that of an enclosing
+    `updating_parameters` if an update is made within a transformation like `jit` or `vmap`."""
+    stack = trace_state.trace_stack
+    return (len(stack.downward), len(trace_state.substack),
+            tuple(master for master in stack.upward if master.trace_type is not ApplyTrace))
+
+
+def update_parameter(parameter, value):
+    """When called inside a parametrized function, replaces `parameter`, a value obtained from
+    `parameter(...)`, by `value` after each optimizer update, i. e. for running statistics
+    that are not trained via gradients. Has no effect if the function is only applied."""
+    update_parameter_p.bind(parameter, value)
+
+
+def updating_parameters(fun):
+    """Returns a function like `fun(parameters, *inputs, **kwargs)` that returns the result of
+    `fun` along with the updates from `update_parameter`, as a dict from the position of each
+    updated parameter among the leaves of `parameters` to its new value.
+    `fun` has to pass `parameters` (or a tree of the same structure) to `apply`."""
+
+    def updating_fun(parameters, *inputs, **kwargs):
+        leaves, treedef = tree_flatten(parameters)
+        _parameter_updates.append((treedef, _trace_context(), {}))
+        try:
+            outputs = fun(parameters, *inputs, **kwargs)
+        finally:
+            _, _, updates = _parameter_updates.pop()
+
+        return outputs, {position: lax.convert_element_type(value, leaves[position].dtype)
+                         for position, value in updates.items()}
+
+    return updating_fun
+
+
+def updated_parameters(fun, parameters, *inputs, **kwargs):
+    """Returns a tree of flags like `parameters` that are set for the parameters updated by
+    `fun(parameters, *inputs, **kwargs)` via `update_parameter`, i. e. to pass to `init` of an
+    optimizer. Only traces `fun`, without evaluating it."""
+    leaves, treedef = tree_flatten(parameters)
+    _, updates = jax.eval_shape(updating_parameters(fun), parameters, *inputs, **kwargs)
+    return tree_unflatten(treedef, [position in updates for position in range(len(leaves))])
+
+
 class parametrized(Primitive):
     """Represents a parametrized function, providing an
     `init_parameters` function for bundled initialization of all parameters,
@@ -111,14 +177,36 @@ class parametrized(Primitive):
         self._wrapped_fun = wrap_init(fun) if fun else None
         self._wrapped_example_outputs_fun = wrap_init(self._example_outputs)
         self._jitted_apply = jit(self._apply)
+        # To avoid recompilation on every call:
+        self._jitted_init_parameters_batched = jit(self._init_parameters_batched)
 
     def init_parameters(self, *example_inputs, key, reuse=None):
+        """If `key` is a batch of keys, equivalent to `init_parameters_batched`."""
+        if len(key.shape) > 1:
+            return self.init_parameters_batched(*example_inputs, keys=key, reuse=reuse)
+
         return self._init_parameters(*example_inputs, key=key, reuse=reuse, reuse_only=False)
 
+    def init_parameters_batched(self, *example_inputs, keys, reuse=None):
+        """Returns parameters for each of the given `keys` (i. e. from `random.split(key, n)`),
+        stacked along a new leading axis of each array, in the same namedtuple layout.
+        The module is traced once, and initialization is compiled into a single program,
+        which is reused for example inputs of the same shapes (unless `reuse` is given)."""
+        if reuse:
+            return jit(partial(self._init_parameters_batched, reuse=reuse))(keys, *example_inputs)
+
+        return self._jitted_init_parameters_batched(keys, *example_inputs)
+
+    def _init_parameters_batched(self, keys, *example_inputs, reuse=None):
+        return vmap(lambda key: self._init_parameters(
+            *example_inputs, key=key, reuse=reuse, reuse_only=False))(keys)
+
     def parameters_from(self, reuse, *example_inputs):
         return self._init_parameters(*example_inputs, key=PRNGKey(0), reuse=reuse, reuse_only=True)
 
-    def _apply(self, parameters, *inputs, key):
+    def _apply(self, parameters, *inputs, key, substitute=None):
+        """`substitute(module)` can return a function to use in place of `module.apply`
+        for submodules, or `None`."""
         flat_inputs, in_tree = tree_flatten(inputs)
         flat_fun, out_tree = flatten_fun_nokwargs(self._wrapped_fun, in_tree)
         apply_trace = _top_trace(filter_type=ApplyTrace)
@@ -126,7 +214,10 @@ class parametrized(Primitive):
             global_parameters_by_primitive = apply_trace.state.global_parameters_by_primitive \
                 if apply_trace else {}
             random_state = apply_trace.state.random_state if apply_trace else RandomState(key)
-            master.state = ApplyTraceState(random_state, parameters, global_parameters_by_primitive)
+            substitute = apply_trace.state.substitute if apply_trace else substitute
+            root_parameters = apply_trace.state.root_parameters if apply_trace else parameters
+            master.state = ApplyTraceState(random_state, parameters, global_parameters_by_primitive,
+                                           substitute, root_parameters)
             flat_outputs = _apply_transform(flat_fun, master).call_wrapped(*flat_inputs)
             del master
         return tree_unflatten(out_tree(), flat_outputs)
@@ -138,6 +229,57 @@ class parametrized(Primitive):
         parameters = self.parameters_from(reuse, *example_inputs)
         return self.apply(parameters, *example_inputs, key=key, jit=jit)
 
+    def freeze(self, parameters, *example_inputs):
+        """Returns a function that applies this module with `parameters` to inputs shaped like
+        `example_inputs`, i. e. for serving. It is compiled once, with parameters embedded as
+        constants on the device, and calls the compiled computation directly with the inputs,
+        without tracing or passing parameters. Raises a `ValueError` for inputs that are not
+        structured, shaped and typed like `example_inputs`."""
+        flat_example_inputs, in_tree = tree_flatten(example_inputs)
+        flat_fun, out_tree_thunk = flatten_fun_nokwargs(
+            wrap_init(partial(self._apply, parameters, key=no_key)), in_tree)
+        compiled = xla._xla_callable(flat_fun, None, None,
+                                     *map(xla.arg_spec, flat_example_inputs))
+        out_tree = out_tree_thunk()
+
+        def avals_of(flat_inputs):
+            return [aval.strip_weak_type() for aval in _abstractified(flat_inputs)]
+
+        example_avals = avals_of(flat_example_inputs)
+
+        def frozen(*inputs):
+            flat_inputs, inputs_tree = tree_flatten(inputs)
+            avals = avals_of(flat_inputs)
+            if inputs_tree != in_tree or avals != example_avals:
+                raise ValueError(f'Frozen {self} expects inputs like {example_avals} '
+                                 f'(structured like {in_tree}), got {avals} '
+                                 f'(structured like {inputs_tree}).')
+
+            return tree_unflatten(out_tree, compiled(*flat_inputs))
+
+        return frozen
+
+    def export(self, parameters, path: Path, *example_inputs):
+        """Writes the computation of `apply` for inputs shaped like `example_inputs` as a jaxpr,
+        followed by constants and `parameters` as raw arrays, to the file at `path`.
+        `load_exported` returns a function of the inputs from it,
+        without requiring the code that defines this module."""
+        flat_parameters, _ = tree_flatten(parameters)
+        flat_args, in_tree = tree_flatten((parameters, example_inputs))
+        flat_fun, out_tree = flatten_fun_nokwargs(
+            wrap_init(lambda parameters, inputs: self.apply(parameters, *inputs)), in_tree)
+        jaxpr, _, consts = _instantiated_trace_to_jaxpr(flat_fun, _abstractified(flat_args))
+        jaxpr = _inlined(jaxpr)
+        arrays = list(map(onp.asarray, list(consts) + flat_parameters))
+        header = dict(jaxpr=jaxpr, consts_count=len(consts),
+                      outputs=tree_unflatten(out_tree(), [0] * len(jaxpr.outvars)),
+                      arrays=[(array.shape, array.dtype) for array in arrays])
+
+        with path.open('wb') as file:
+            _ExportPickler(file).dump(header)
+            for array in arrays:
+                file.write(onp.ascontiguousarray(array).tobytes())
+
     def __call__(self, *inputs):
         flat_inputs, in_tree = tree_flatten(inputs)
         out_tree_container = []
@@ -230,16 +372,12 @@ class parametrized(Primitive):
     def _Parameters(name, *names):
         return namedtuple(name, names)
 
-    def _parameters_namedtuple(self, parameters_dict):
-        if not isinstance(parameters_dict, dict):
-            return parameters_dict
-
+    @staticmethod
+    def _submodule_names(parameters_dict):
+        """Names of submodules in the parameters namedtuple, in the order of `parameters_dict`."""
         index_by_prefix = defaultdict(lambda: 0)
 
-        prefix_param_pairs = [(module.__name__, module._parameters_namedtuple(parameters))
-                              for module, parameters in parameters_dict.items()]
-
-        prefix_counter = Counter([prefix for prefix, _ in prefix_param_pairs])
+        prefix_counter = Counter([module.__name__ for module in parameters_dict.keys()])
 
         def next_name(prefix):
             is_duplicate = prefix_counter[prefix] > 1
@@ -248,10 +386,44 @@ class parametrized(Primitive):
             index_by_prefix[prefix] = index + 1
             return name
 
-        params = dict((next_name(prefix), params) for prefix, params in prefix_param_pairs)
+        return [next_name(module.__name__) for module in parameters_dict.keys()]
+
+    def _parameters_namedtuple(self, parameters_dict):
+        if not isinstance(parameters_dict, dict):
+            return parameters_dict
+
+        params = dict((name, module._parameters_namedtuple(parameters))
+                      for name, (module, parameters)
+                      in zip(parametrized._submodule_names(parameters_dict),
+                             parameters_dict.items()))
         Parameters = parametrized._Parameters(self.__name__, *params.keys())
         return Parameters(**params)
 
+    def path_to(self, submodule, *example_inputs):
+        """Returns the path to the parameters of `submodule` within the parameters of this module,
+        as a tuple of names, i. e. `('sequential', 'dense0')` for `params.sequential.dense0`."""
+        parameters_dict, _ = self._init_and_apply_parameters_dict(*example_inputs, key=PRNGKey(0))
+        path = self._path_to(submodule, parameters_dict)
+        if path is None:
+            raise ValueError(f'{submodule} has no parameters within {self}.')
+
+        return path
+
+    def _path_to(self, submodule, parameters_dict):
+        if self == submodule:
+            return ()
+
+        if not isinstance(parameters_dict, dict):
+            return None
+
+        for name, (module, parameters) in zip(parametrized._submodule_names(parameters_dict),
+                                              parameters_dict.items()):
+            path = module._path_to(submodule, parameters)
+            if path is not None:
+                return (name,) + path
+
+        return None
+
     @staticmethod
     def _parameters_dict(parameters, example_parameters_dict):
         if not isinstance(parameters, tuple):
@@ -300,9 +472,21 @@ class ShapedParametrized:
     def apply_from(self, reuse, key=no_key, jit=False):
         return self.parametrized.apply_from(reuse, *self.example_inputs, key=key, jit=jit)
 
+    def freeze(self, parameters):
+        return self.parametrized.freeze(parameters, *self.example_inputs)
+
+    def export(self, parameters, path: Path):
+        return self.parametrized.export(parameters, path, *self.example_inputs)
+
     def init_parameters(self, key):
         return self.parametrized.init_parameters(*self.example_inputs, key=key)
 
+    def init_parameters_batched(self, keys):
+        return self.parametrized.init_parameters_batched(*self.example_inputs, keys=keys)
+
+    def path_to(self, submodule):
+        return self.parametrized.path_to(submodule, *self.example_inputs)
+
 
 def _abstractified(vals):
     return tuple(map(_abstractify, vals))
@@ -338,6 +522,21 @@ def _flat_initial_style_jaxpr(fun, in_avals):
                       out_avals=map(raise_to_shaped, out_avals)), consts
 
 
+def _is_parametrized(jaxpr):
+    """Whether `jaxpr` contains parametrized functions or random keys, possibly nested."""
+    for eqn in jaxpr.eqns:
+        if isinstance(eqn.primitive, parametrized) or eqn.primitive is random_key_p:
+            return True
+
+        if eqn.primitive is scan_p and _is_parametrized(eqn.params['jaxpr'].jaxpr):
+            return True
+
+        if any(_is_parametrized(subjaxpr) for subjaxpr, _, _ in eqn.bound_subjaxprs):
+            return True
+
+    return False
+
+
 def _custom_cell_scan_impl(flat_cell, *args, **kwargs):
     """lax_control_flow._scan_impl, but allowing for a custom cell function."""
 
@@ -442,27 +641,54 @@ class ParametrizedTrace(Trace):
         assert False
 
     _rules = {lax.scan_p: lambda self: self._process_scan,
-              random_key_p: lambda self: self._process_random_key}
+              random_key_p: lambda self: self._process_random_key,
+              update_parameter_p: lambda self: self._process_update_parameter}
 
     def _process_scan(self, args, kwargs):
         jaxpr = kwargs['jaxpr']
 
-        is_cell_parametrized = (len(jaxpr.jaxpr.eqns) == 1 and
-                                isinstance(jaxpr.jaxpr.eqns[0].primitive, parametrized))
-
-        if not is_cell_parametrized:
+        if not _is_parametrized(jaxpr.jaxpr):
             return _scan_impl(*args, **kwargs)
 
-        eqn, = jaxpr.jaxpr.eqns
-        flat_cell = partial(self.process_parametrized, eqn.primitive, **eqn.params)
+        flat_cell = partial(self._eval_jaxpr, jaxpr.jaxpr, jaxpr.literals, ())
         return _custom_cell_scan_impl(flat_cell, *args, **kwargs)
 
+    def _eval_jaxpr(self, jaxpr, consts, freevar_vals, *args):
+        """Like `jax.core.eval_jaxpr`, but processing parametrized functions with this trace,
+        so that scanned cells can be composed of multiple parametrized functions."""
+
+        def read(v):
+            return v.val if type(v) is Literal else env[v]
+
+        env = {unitvar: unit}
+        env.update(zip(jaxpr.constvars, consts))
+        env.update(zip(jaxpr.invars, args))
+        env.update(zip(jaxpr.freevars, freevar_vals))
+        for eqn in jaxpr.eqns:
+            in_vals = map(read, eqn.invars)
+            if eqn.bound_subjaxprs:
+                subfuns = [wrap_init(partial(self._eval_jaxpr, subjaxpr, map(read, const_bindings),
+                                             map(read, freevar_bindings)))
+                           for subjaxpr, const_bindings, freevar_bindings in eqn.bound_subjaxprs]
+                outs = eqn.primitive.bind(*(subfuns + in_vals), **eqn.params)
+            else:
+                outs = self._process_primitive(eqn.primitive, in_vals, eqn.params)
+
+            env.update(zip(eqn.outvars, outs if eqn.primitive.multiple_results else [outs]))
+
+        return map(read, jaxpr.outvars)
+
     def _process_random_key(self, args, kwargs):
         assert len(args) == 0
         assert len(kwargs) == 0
 
         return self.state.random_state.next_key()
 
+    def _process_update_parameter(self, args, kwargs):
+        assert len(kwargs) == 0
+
+        return []
+
     def pure(self, val):
         return ParametrizedTracer(self, val)
 
@@ -543,12 +769,16 @@ class ApplyTraceState(ParametrizedTraceState):
     """Allows supplying submodules with their respective parameters while calling a module's `apply`
     function by iterating through the given parameters."""
 
-    def __init__(self, random_state, parameters, global_parameters_by_primitive):
+    def __init__(self, random_state, parameters, global_parameters_by_primitive, substitute=None,
+                 root_parameters=None):
         super().__init__(random_state)
 
         self.parameters = parameters
         self._index = 0
         self.global_parameters_by_primitive = global_parameters_by_primitive
+        self.substitute = substitute
+        # parameters passed to the outermost `apply`, to locate updated parameters:
+        self.root_parameters = parameters if root_parameters is None else root_parameters
 
     def next_parameters_for(self, primitive: Primitive):
         parameters = self.global_parameters_by_primitive.get(primitive)
@@ -569,12 +799,35 @@ class ApplyTrace(ParametrizedTrace):
         return self.master.state
 
     def _process_parametrized_nonflat(self, primitive: parametrized, *inputs):
-        return primitive.apply(self.state.next_parameters_for(primitive), *inputs)
+        substituted_apply = self.state.substitute(primitive) if self.state.substitute else None
+        apply = substituted_apply or primitive.apply
+        return apply(self.state.next_parameters_for(primitive), *inputs)
 
     def _process_jitted(self, primitive, f, inputs, kwargs):
         fun = _apply_transform(f, self.master)
         return primitive.bind(fun, *inputs, **kwargs)
 
+    def _process_update_parameter(self, args, kwargs):
+        assert len(kwargs) == 0
+
+        if not _parameter_updates:
+            return []
+
+        parameter, value = args
+        treedef, trace_context, updates = _parameter_updates[-1]
+        if _trace_context() != trace_context:
+            raise ValueError('Parameters cannot be updated from within transformations '
+                             'like `jit` or `vmap`, i. e. from `apply(..., jit=True)`.')
+
+        leaves, root_treedef = tree_flatten(self.state.root_parameters)
+        position = next((i for i, leaf in enumerate(leaves) if leaf is parameter), None)
+        if position is None or root_treedef != treedef:
+            raise ValueError('`update_parameter` requires a value returned by `parameter`, '
+                             'with the parameters passed to the updating function to `apply`.')
+
+        updates[position] = value
+        return []
+
 
 def _get_name_for(fun):
     while hasattr(fun, '__wrapped__'):
@@ -595,3 +848,127 @@ def save(parameters, path: Path):
 def load(path: Path):
     with path.open('rb') as file:
         return dill.load(file)
+
+
+def _primitives_by_name():
+    primitives = {}
+    for name, module in list(sys.modules.items()):
+        if name == 'jax' or name.startswith('jax.'):
+            for value in list(vars(module).values()):
+                if isinstance(value, Primitive):
+                    primitives.setdefault(value.name, value)
+
+    return primitives
+
+
+def _is_custom_transforms(eqn):
+    """Whether `eqn` calls a function defined via `jax.custom_transforms`, i. e. `expit` of
+    `jax.nn.sigmoid`, which is represented by a primitive that is created for each function."""
+    return set(eqn.params) == {'jaxpr', 'in_tree', 'out_tree', 'num_consts'}
+
+
+def _inlined_eqns(jaxpr, renamed):
+    """Equations and output variables of `jaxpr`, with `custom_transforms` calls replaced by the
+    equations of their implementation, and variables replaced as given by `renamed`."""
+
+    def read(v):
+        return v if type(v) is Literal else renamed.get(v, v)
+
+    def inlined_param(param):
+        if isinstance(param, TypedJaxpr):
+            return TypedJaxpr(_inlined(param.jaxpr), param.literals, param.in_avals,
+                              param.out_avals)
+
+        return _inlined(param) if isinstance(param, Jaxpr) else param
+
+    eqns = []
+    for eqn in jaxpr.eqns:
+        invars = map(read, eqn.invars)
+        if _is_custom_transforms(eqn):
+            inner = eqn.params['jaxpr']
+            inner_eqns, outvars = _inlined_eqns(
+                inner, dict(zip(inner.constvars + inner.invars, invars)))
+            eqns += inner_eqns
+            renamed.update(zip(eqn.outvars, outvars))
+            continue
+
+        eqns.append(eqn._replace(
+            invars=invars,
+            bound_subjaxprs=[(_inlined(subjaxpr), map(read, const_bindings),
+                              map(read, freevar_bindings))
+                             for subjaxpr, const_bindings, freevar_bindings
+                             in eqn.bound_subjaxprs],
+            params={name: inlined_param(param) for name, param in eqn.params.items()}))
+
+    return eqns, map(read, jaxpr.outvars)
+
+
+def _inlined(jaxpr):
+    """`jaxpr` with `custom_transforms` calls inlined (also within subjaxprs, i. e. of `scan`),
+    since their primitives cannot be exported."""
+    eqns, outvars = _inlined_eqns(jaxpr, {})
+    return Jaxpr(jaxpr.constvars, jaxpr.freevars, jaxpr.invars, outvars, eqns)
+
+
+class _ExportPickler(pickle.Pickler):
+    """Stores primitives by name, since their rules cannot be pickled."""
+
+    def __init__(self, file):
+        super().__init__(file)
+        self._primitives = _primitives_by_name()
+
+    def persistent_id(self, obj):
+        if obj is unit:
+            return 'unit', None
+
+        if obj is unitvar:
+            return 'unitvar', None
+
+        if not isinstance(obj, Primitive):
+            return None
+
+        if self._primitives.get(obj.name) is not obj:
+            raise ValueError(f'Cannot export {obj.name}, since it is not a primitive of jax.')
+
+        return 'primitive', obj.name
+
+
+class _ExportUnpickler(pickle.Unpickler):
+    def __init__(self, file):
+        super().__init__(file)
+        self._primitives = _primitives_by_name()
+
+    def persistent_load(self, pid):
+        kind, name = pid
+        if kind == 'unit':
+            return unit
+
+        if kind == 'unitvar':
+            return unitvar
+
+        primitive = self._primitives.get(name)
+        if primitive is None:
+            raise ValueError(f'Unknown primitive {name}, exported with another version of jax?')
+
+        return primitive
+
+
+def load_exported(path: Path):
+    """Returns a compiled function of the inputs from a file written by `parametrized.export`,
+    with parameters embedded as constants. Does not require the code of the exported module."""
+    with path.open('rb') as file:
+        header = _ExportUnpickler(file).load()
+        arrays = [onp.frombuffer(file.read(int(onp.prod(shape)) * dtype.itemsize),
+                                 dtype).reshape(shape) for shape, dtype in header['arrays']]
+
+    jaxpr = header['jaxpr']
+    consts, flat_parameters = split_list(arrays, [header['consts_count']])
+    out_tree = tree_structure(header['outputs'])
+
+    @jit
+    def exported(*inputs):
+        flat_inputs, _ = tree_flatten(inputs)
+        flat_outputs = eval_jaxpr(jaxpr, consts, (), *(flat_parameters + flat_inputs))
+        return tree_unflatten(out_tree, flat_outputs)
+
+    return exported
@@ -1,11 +1,14 @@
 import functools
 import itertools
+import warnings
 
-from jax import random, lax, numpy as np, tree_map, tree_leaves, vmap, partial
+import numpy as onp
+from jax import random, lax, numpy as np, tree_map, tree_multimap, tree_leaves, vmap, partial, \
+    jit, remat
 from jax.nn import sigmoid
 from jax.nn.initializers import glorot_normal, normal, zeros, ones
 
-from jaxnet.core import parametrized, Parameter, random_key
+from jaxnet.core import parametrized, Parameter, random_key, update_parameter, no_key
 
 
 def parameter(shape, init, name=None):
@@ -21,6 +24,7 @@ def Dense(out_dim, kernel_init=glorot_normal(), bias_init=normal()):
         bias = parameter((out_dim,), bias_init, name='bias')
         return np.dot(inputs, kernel) + bias
 
+    dense._channel_axes = (-1, -1)
     return dense
 
 
@@ -44,6 +48,7 @@ def Sequential(*layers):
             inputs = layer(inputs)
         return inputs
 
+    sequential._layers = layers
     return sequential
 
 
@@ -75,6 +80,8 @@ def GeneralConv(dimension_numbers, out_chan, filter_shape, strides=None, padding
                                         lhs_dilation=one, rhs_dilation=dilation,
                                         dimension_numbers=dimension_numbers) + bias
 
+    # axes of output channels of kernel and outputs, for `fold_batch_norm`:
+    conv._channel_axes = (rhs_spec.index('O'), out_spec.index('C'))
     return conv
 
 
@@ -168,20 +175,303 @@ def GRUCell(carry_size, param_init):
     return gru_cell, carry_init
 
 
-def Rnn(cell, carry_init):
+def FusedGRUCell(carry_size, param_init):
+    """GRU cell computing the same function as `GRUCell` (plus an input bias),
+    with an input projection to be hoisted out of the recurrence by `Rnn`:
+    Input projections for all time steps are computed in one matrix multiplication,
+    leaving one fused recurrent matrix multiplication for both gates per step."""
+
+    @parametrized
+    def gru_cell(carry, projected_x):
+        x_gates, x_compute = np.split(projected_x, [2 * carry_size], axis=-1)
+        gates_kernel = parameter((carry_size, 2 * carry_size), param_init, 'gates_kernel')
+        update, reset = np.split(sigmoid(x_gates + np.dot(carry, gates_kernel)), 2, axis=-1)
+        compute_kernel = parameter((carry_size, carry_size), param_init, 'compute_kernel')
+        compute = np.tanh(x_compute + np.dot(reset * carry, compute_kernel))
+        out = update * compute + (1 - update) * carry
+        return out, out
+
+    def carry_init(batch_size):
+        return np.zeros((batch_size, carry_size))
+
+    return gru_cell, carry_init, Dense(3 * carry_size, param_init, zeros)
+
+
+def LSTMCell(carry_size, param_init):
+    """LSTM cell with an input projection to be hoisted out of the recurrence by `Rnn`,
+    leaving one fused recurrent matrix multiplication for all gates per step.
+    The carry consists of cell and hidden state."""
+
+    @parametrized
+    def lstm_cell(carry, projected_x):
+        cell_state, hidden = carry
+        kernel = parameter((carry_size, 4 * carry_size), param_init, 'recurrent_kernel')
+        input_gate, forget_gate, compute, output_gate = \
+            np.split(projected_x + np.dot(hidden, kernel), 4, axis=-1)
+        cell_state = sigmoid(forget_gate) * cell_state + sigmoid(input_gate) * np.tanh(compute)
+        hidden = sigmoid(output_gate) * np.tanh(cell_state)
+        return (cell_state, hidden), hidden
+
+    def carry_init(batch_size):
+        return np.zeros((batch_size, carry_size)), np.zeros((batch_size, carry_size))
+
+    return lstm_cell, carry_init, Dense(4 * carry_size, param_init, zeros)
+
+
+def _where(condition, x, y):
+    """Selects between trees `x` and `y`, with `condition` applying to leading axes,
+    i. e. of shape (batch,) to select per example."""
+
+    def where(x, y):
+        return np.where(np.reshape(condition, np.shape(condition) +
+                                   (1,) * (np.ndim(x) - np.ndim(condition))), x, y)
+
+    return tree_multimap(where, x, y)
+
+
+def _sequence_mask(length, lengths):
+    """Whether each time step is within the given lengths, shape (sequence, batch)."""
+    return np.arange(length)[:, np.newaxis] < lengths
+
+
+def _zero_padded(ys, mask):
+    return _where(mask, ys, tree_map(np.zeros_like, ys))
+
+
+def _scan(f, init, xs, remat_every=None):
+    """`lax.scan`, optionally rematerialized: Only every `remat_every`-th carry is stored for the
+    backward pass, steps in between are recomputed, reducing memory from O(T) to O(T/k + k).
+    If the length is not divisible by `remat_every`, the sequence is padded,
+    keeping the carry fixed during padding steps."""
+    if remat_every is None:
+        return lax.scan(f, init, xs)
+
+    length = tree_leaves(xs)[0].shape[0]
+    padding = -length % remat_every
+    if padding:
+        def masked_f(carry, x_and_mask):
+            x, mask = x_and_mask
+            new_carry, y = f(carry, x)
+            return _where(mask, new_carry, carry), y
+
+        padded = tree_map(
+            lambda x: np.concatenate((x, np.zeros((padding,) + x.shape[1:], x.dtype))), xs)
+        mask = np.arange(length + padding) < length
+        carry, ys = _scan(masked_f, init, (padded, mask), remat_every)
+        return carry, tree_map(lambda y: y[:length], ys)
+
+    @remat
+    def scan_chunk(carry, xs):
+        return lax.scan(f, carry, xs)
+
+    chunks = tree_map(lambda x: np.reshape(x, (-1, remat_every) + x.shape[1:]), xs)
+    carry, ys = lax.scan(scan_chunk, init, chunks)
+    return carry, tree_map(lambda y: np.reshape(y, (length,) + y.shape[2:]), ys)
+
+
+def Rnn(cell, carry_init, input_projection=None, return_carry=False, remat_every=None):
     """Layer construction function for recurrent neural nets.
     Expecting input shape (batch, sequence, channels).
-    TODO allow returning last carry."""
+    If given, `input_projection` is applied to the inputs of all time steps at once,
+    before scanning `cell` over its outputs.
+    Optionally takes the initial carry as a second input, i. e. the final carry of a previous call
+    for stateful processing of a stream. If `return_carry`, returns outputs and the final carry.
+    Optionally takes the length of each sequence as a third input, shape (batch,):
+    The carry is kept fixed beyond the length, and the corresponding outputs are zero.
+    With `remat_every=k`, gradients are computed storing only every k-th carry,
+    recomputing the steps in between."""
 
     @parametrized
-    def rnn(xs):
+    def rnn(xs, carry=None, lengths=None):
         xs = np.swapaxes(xs, 0, 1)
-        _, ys = lax.scan(cell, carry_init(xs.shape[1]), xs)
-        return np.swapaxes(ys, 0, 1)
+        if input_projection is not None:
+            xs = input_projection(xs)
+
+        if carry is None:
+            carry = carry_init(xs.shape[1])
+
+        if lengths is None:
+            carry, ys = _scan(cell, carry, xs, remat_every)
+        else:
+            def masked_cell(carry, x_and_mask):
+                x, mask = x_and_mask
+                new_carry, y = cell(carry, x)
+                return _where(mask, new_carry, carry), y
+
+            mask = _sequence_mask(xs.shape[0], lengths)
+            carry, ys = _scan(masked_cell, carry, (xs, mask), remat_every)
+            ys = _zero_padded(ys, mask)
+
+        ys = np.swapaxes(ys, 0, 1)
+        return (ys, carry) if return_carry else ys
 
     return rnn
 
 
+def rnn_step(rnn):
+    """Returns a jitted function `(parameters, x, carry) -> (y, carry)` that applies `rnn`
+    (created with `return_carry=True`) to a single time step, given inputs of shape
+    (batch, channels). Allows streaming inference at constant cost per time step."""
+
+    @jit
+    def step(parameters, x, carry):
+        ys, carry = rnn.apply(parameters, x[:, np.newaxis], carry)
+        return ys[:, 0], carry
+
+    return step
+
+
+def _unpack_cell(cell):
+    """Cell, carry initializer and input projection (or `None`),
+    from a tuple as returned by cell constructors like `GRUCell` or `LSTMCell`."""
+    cell, carry_init, *input_projection = cell
+    return cell, carry_init, input_projection[0] if input_projection else None
+
+
+def StackedRnn(*cells, return_carry=False, remat_every=None):
+    """Multi-layer recurrent net running all layers in a single scan,
+    instead of one per layer as in a `Sequential` of `Rnn`s.
+    Expecting input shape (batch, sequence, channels).
+    Each of `cells` is a tuple as returned by cell constructors like `FusedGRUCell`.
+    Layers are evaluated in wavefront order: In each step, layer `i` processes time step `t - i`,
+    so that the layers of a step are independent of each other.
+    The input projection of the first layer is applied to all time steps before the scan.
+    Initial and final carry are lists with the carry of each layer.
+    Takes carry and sequence lengths as optional inputs, and supports `remat_every` like `Rnn`."""
+    cells = tuple(map(_unpack_cell, cells))
+    num_layers = len(cells)
+
+    @parametrized
+    def stacked_rnn(xs, carries=None, lengths=None):
+        xs = np.swapaxes(xs, 0, 1)
+        length, batch_size = xs.shape[:2]
+        _, _, input_projection = cells[0]
+        if input_projection is not None:
+            xs = input_projection(xs)
+
+        # pad for the wavefront to pass through all layers:
+        xs = np.concatenate((xs, np.zeros((num_layers - 1,) + xs.shape[1:], xs.dtype)))
+
+        def layer_step(layer, carry, inputs):
+            cell, _, input_projection = cells[layer]
+            if layer > 0 and input_projection is not None:
+                inputs = input_projection(inputs)
+
+            return cell(carry, inputs)
+
+        carries = [carry_init(batch_size) for _, carry_init, _ in cells] \
+            if carries is None else list(carries)
+        outputs = [None] * (num_layers - 1)
+
+        # the wavefront enters the layers one by one:
+        for step in range(num_layers - 1):
+            layer_inputs = [xs[step]] + outputs
+            for layer in range(min(step + 1, num_layers - 1)):
+                if step - layer < length:
+                    carry, outputs[layer] = layer_step(layer, carries[layer], layer_inputs[layer])
+                    carries[layer] = carry if lengths is None else \
+                        _where(step - layer < lengths, carry, carries[layer])
+
+        def wavefront_step(carries_and_outputs, step_and_x):
+            carries, outputs = carries_and_outputs
+            step, x = step_and_x
+            new_carries, new_outputs = [], []
+            for layer, (carry, inputs) in enumerate(zip(carries, [x] + outputs)):
+                new_carry, output = layer_step(layer, carry, inputs)
+                # layers that are already done with the sequence keep their carry:
+                new_carries.append(_where(
+                    step - layer < (length if lengths is None else lengths), new_carry, carry))
+                new_outputs.append(output)
+
+            return (new_carries, new_outputs[:-1]), new_outputs[-1]
+
+        steps = np.arange(num_layers - 1, length + num_layers - 1)
+        (carries, _), ys = _scan(wavefront_step, (carries, outputs),
+                                 (steps, xs[num_layers - 1:]), remat_every)
+        if lengths is not None:
+            ys = _zero_padded(ys, _sequence_mask(length, lengths))
+
+        ys = np.swapaxes(ys, 0, 1)
+        return (ys, carries) if return_carry else ys
+
+    return stacked_rnn
+
+
+def length_bucketed_batches(sequences, batch_size, max_shapes=4, seed=None):
+    """Yields batches `(inputs, lengths)` of `sequences` with different lengths,
+    each sequence an array of shape (length, channels), for recurrent nets taking lengths.
+    Sequences are sorted by length and batched consecutively to minimize padding.
+    Each batch is padded to one of at most `max_shapes` lengths (quantiles of all lengths),
+    bounding the number of distinct shapes to compile for.
+    The last batch is filled up with empty sequences.
+    If `seed` is given, batches are yielded in random order."""
+    lengths = onp.array([len(sequence) for sequence in sequences])
+    order = onp.argsort(lengths, kind='stable')
+    quantile_indices = onp.ceil(onp.linspace(0, 1, max_shapes + 1)[1:] * len(lengths)) - 1
+    padded_lengths = onp.unique(lengths[order][quantile_indices.astype(int)])
+
+    batches = [order[start:start + batch_size] for start in range(0, len(order), batch_size)]
+    if seed is not None:
+        onp.random.RandomState(seed).shuffle(batches)
+
+    example = sequences[order[0]]
+    for batch in batches:
+        batch_lengths = lengths[batch]
+        padded_length = padded_lengths[onp.searchsorted(padded_lengths, batch_lengths.max())]
+        inputs = onp.zeros((batch_size, padded_length) + example.shape[1:], example.dtype)
+        for i, index in enumerate(batch):
+            inputs[i, :lengths[index]] = sequences[index]
+
+        yield inputs, onp.pad(batch_lengths, (0, batch_size - len(batch)))
+
+
+def _reversed(xs, lengths):
+    """Reverses `xs` of shape (sequence, batch, ...) along time,
+    within the given length of each sequence, if any."""
+    if lengths is None:
+        return np.flip(xs, 0)
+
+    time = np.arange(xs.shape[0])[:, np.newaxis]
+    return xs[np.where(time < lengths, lengths - 1 - time, time), np.arange(xs.shape[1])]
+
+
+def Bidirectional(forward_cell, backward_cell):
+    """Bidirectional recurrent net, running both directions in a single scan.
+    Expecting input shape (batch, sequence, channels).
+    Each cell is a tuple as returned by cell constructors like `FusedGRUCell`.
+    Outputs of both directions are concatenated along the channel axis.
+    Input projections are applied to all time steps before the scan.
+    Optionally takes the length of each sequence as a second input, shape (batch,):
+    The backward direction then starts at the end of each sequence, outputs beyond are zero."""
+    forward_cell, forward_carry_init, forward_projection = _unpack_cell(forward_cell)
+    backward_cell, backward_carry_init, backward_projection = _unpack_cell(backward_cell)
+
+    @parametrized
+    def bidirectional(xs, lengths=None):
+        xs = np.swapaxes(xs, 0, 1)
+        batch_size = xs.shape[1]
+        forward_xs = xs if forward_projection is None else forward_projection(xs)
+        backward_xs = xs if backward_projection is None else backward_projection(xs)
+
+        def step(carries, xs):
+            forward_carry, backward_carry = carries
+            forward_x, backward_x = xs
+            forward_carry, forward_y = forward_cell(forward_carry, forward_x)
+            backward_carry, backward_y = backward_cell(backward_carry, backward_x)
+            return (forward_carry, backward_carry), (forward_y, backward_y)
+
+        carries = forward_carry_init(batch_size), backward_carry_init(batch_size)
+        _, (forward_ys, backward_ys) = lax.scan(step, carries,
+                                                (forward_xs, _reversed(backward_xs, lengths)))
+        ys = np.concatenate((forward_ys, _reversed(backward_ys, lengths)), axis=-1)
+        if lengths is not None:
+            ys = _zero_padded(ys, _sequence_mask(ys.shape[0], lengths))
+
+        return np.swapaxes(ys, 0, 1)
+
+    return bidirectional
+
+
 def Dropout(rate, test_mode=False):
     """Constructor for a dropout function with given rate."""
     rate = np.array(rate)
@@ -203,24 +493,148 @@ def fastvar(x, axis, keepdims):
 
 
 def BatchNorm(axis=(0, 1, 2), epsilon=1e-5, center=True, scale=True,
-              beta_init=zeros, gamma_init=ones):
-    """Layer construction function for a batch normalization layer."""
+              beta_init=zeros, gamma_init=ones, momentum=None, test_mode=False):
+    """Layer construction function for a batch normalization layer.
+    If `momentum` is given, running averages of mean and variance are kept as parameters
+    `mean` and `var`. These are updated from batch statistics with each optimizer update instead
+    of being trained via gradients. In `test_mode`, they are used instead of batch statistics,
+    so that normalization is a per-channel affine transformation without batch reductions."""
 
     axis = (axis,) if np.isscalar(axis) else axis
+    if test_mode and momentum is None:
+        raise ValueError('Test mode requires running statistics, i. e. `momentum`.')
 
     @parametrized
     def batch_norm(x):
         ed = tuple(None if i in axis else slice(None) for i in range(np.ndim(x)))
+        shape = tuple(d for i, d in enumerate(x.shape) if i not in axis)
+        if momentum is not None:
+            running_mean = parameter(shape, zeros, 'mean')
+            running_var = parameter(shape, ones, 'var')
+
+        if test_mode:
+            factor, offset = _normalization_affine(
+                running_mean, running_var, parameter(shape, gamma_init, 'gamma') if scale else None,
+                parameter(shape, beta_init, 'beta') if center else None, epsilon)
+            return x * factor[ed] + offset[ed]
+
         mean, var = np.mean(x, axis, keepdims=True), fastvar(x, axis, keepdims=True)
         z = (x - mean) / np.sqrt(var + epsilon)
-        shape = tuple(d for i, d in enumerate(x.shape) if i not in axis)
+
+        if momentum is not None:
+            update_parameter(running_mean, momentum * running_mean +
+                             (1 - momentum) * np.reshape(mean, shape))
+            update_parameter(running_var, momentum * running_var +
+                             (1 - momentum) * np.reshape(var, shape))
 
         scaled = z * parameter(shape, gamma_init, 'gamma')[ed] if scale else z
         return scaled + parameter(shape, beta_init, 'beta')[ed] if center else scaled
 
+    batch_norm._axis = axis
+    batch_norm._affine = None if momentum is None else lambda parameters: _normalization_affine(
+        parameters.mean, parameters.var, parameters.gamma if scale else None,
+        parameters.beta if center else None, epsilon)
     return batch_norm
 
 
+def _normalization_affine(mean, var, gamma, beta, epsilon):
+    """Per-channel factor and offset that are equivalent to normalization with given statistics."""
+    factor = lax.rsqrt(var + epsilon)
+    factor = factor if gamma is None else factor * gamma
+    offset = -mean * factor
+    return factor, offset if beta is None else offset + beta
+
+
+def _batch_norm_in_test_mode(batch_norm, parameters, x):
+    ed = tuple(None if i in batch_norm._axis else slice(None) for i in range(np.ndim(x)))
+    factor, offset = batch_norm._affine(parameters)
+    return x * factor[ed] + offset[ed]
+
+
+def _is_foldable(layer, next_layer, ndim):
+    """Whether `next_layer` is batch normalization with running statistics over the output
+    channels of `layer`, a `Dense` or convolution layer with outputs of rank `ndim`."""
+    if getattr(layer, '_channel_axes', None) is None or \
+            getattr(next_layer, '_affine', None) is None:
+        return False
+
+    _, output_axis = layer._channel_axes
+    return set(range(ndim)) - set(next_layer._axis) == {output_axis % ndim}
+
+
+def _folded(layer, parameters, batch_norm, batch_norm_parameters):
+    """Parameters of `layer` with the subsequent batch normalization folded into them."""
+    factor, offset = batch_norm._affine(batch_norm_parameters)
+    kernel_axis, _ = layer._channel_axes
+    kernel, bias = parameters
+    kernel_shape = tuple(-1 if i == kernel_axis % np.ndim(kernel) else 1
+                         for i in range(np.ndim(kernel)))
+    return type(parameters)(kernel * np.reshape(factor, kernel_shape),
+                            bias * np.reshape(factor, bias.shape) + np.reshape(offset, bias.shape))
+
+
+def _inference_apply(module):
+    """Function to use in place of `module.apply` for `fold_batch_norm`, or `None`."""
+    if getattr(module, '_affine', None) is not None:
+        return partial(_batch_norm_in_test_mode, module)
+
+    if getattr(module, '_layers', None) is not None:
+        return partial(_folded_sequential, module)
+
+    return None
+
+
+def _apply_for_inference(module, parameters, *inputs):
+    apply = _inference_apply(module)
+    if apply is not None:
+        return apply(parameters, *inputs)
+
+    return module._apply(parameters, *inputs, key=no_key, substitute=_inference_apply)
+
+
+def _folded_sequential(sequential, parameters, inputs):
+    layers = sequential._layers
+    parametrized_layers = list(dict.fromkeys(l for l in layers if isinstance(l, parametrized)))
+    if len(parametrized_layers) != len(parameters):
+        # layers call other parametrized functions, so that parameters of layers are not known:
+        if any(getattr(layer, '_channel_axes', None) is not None and
+               getattr(next_layer, '_affine', None) is not None
+               for layer, next_layer in zip(layers, layers[1:])):
+            warnings.warn(f'Batch normalization in {sequential} is not folded, since its layers '
+                          'call other parametrized functions. Use Sequential for those instead.')
+
+        return sequential._apply(parameters, inputs, key=no_key, substitute=_inference_apply)
+
+    parameters_by_layer = dict(zip(parametrized_layers, parameters))
+    i = 0
+    while i < len(layers):
+        layer = layers[i]
+        next_layer = layers[i + 1] if i + 1 < len(layers) else None
+        if _is_foldable(layer, next_layer, np.ndim(inputs)):
+            parameters = _folded(layer, parameters_by_layer[layer],
+                                 next_layer, parameters_by_layer[next_layer])
+            inputs = layer.apply(parameters, inputs)
+            i += 2
+            continue
+
+        inputs = _apply_for_inference(layer, parameters_by_layer[layer], inputs) \
+            if isinstance(layer, parametrized) else layer(inputs)
+        i += 1
+
+    return inputs
+
+
+def fold_batch_norm(model, parameters):
+    """Returns a compiled function of the inputs of `model` for inference with `parameters`.
+    Batch normalization with running statistics (see `BatchNorm`) that directly follows
+    a `Dense` or `Conv` layer in a `Sequential` is folded into kernel and bias of that layer,
+    unless other layers of that `Sequential` are functions that call parametrized functions
+    (with a warning). Other batch normalization with running statistics is applied in test mode.
+    Folded weights are computed once when compiling, and embedded as constants."""
+
+    return jit(partial(_apply_for_inference, model, parameters))
+
+
 def Regularized(loss_model, regularizer):
     @parametrized
     def regularized(*inputs):
@@ -256,3 +670,21 @@ def Batched(unbatched_model: parametrized, batch_dim=0):
         return batched_apply(*batched_args)
 
     return batched
+
+
+def Ensemble(model: parametrized, n, share_inputs=True, average=True):
+    """Evaluates `n` copies of `model` with separate parameters, stacked along a leading axis,
+    in a single vmapped program.
+    If not `share_inputs`, each input has a leading axis of size `n`, one entry per member.
+    Outputs are averaged over members if `average`, otherwise stacked along a leading axis."""
+
+    @parametrized
+    def ensemble(*inputs):
+        example_inputs = inputs if share_inputs else tree_map(lambda x: x[0], inputs)
+        params = Parameter(lambda key: model.init_parameters_batched(
+            *example_inputs, keys=random.split(key, n)), 'model')()
+        input_axes = (None if share_inputs else 0,) * len(inputs)
+        outputs = vmap(model.apply, (0,) + input_axes)(params, *inputs)
+        return tree_map(partial(np.mean, axis=0), outputs) if average else outputs
+
+    return ensemble
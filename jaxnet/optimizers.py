@@ -1,74 +1,348 @@
 from abc import ABC, abstractmethod
 from collections import namedtuple
-from functools import lru_cache
+from functools import lru_cache, reduce
 
 import jax
-from jax import grad, value_and_grad, tree_map, tree_multimap, partial
+import jax.ops
+import numpy as onp
+from jax import numpy as np, lax, random, value_and_grad, tree_map, tree_multimap, partial
+from jax.tree_util import tree_leaves, tree_flatten, tree_unflatten, tree_structure, \
+    _registry as _pytree_registry
 from jax.experimental import optimizers as experimental
+from jax.util import unzip2
 # noinspection PyUnresolvedReferences
 from jax.experimental.optimizers import constant, exponential_decay, inverse_time_decay, \
     polynomial_decay, piecewise_constant
 
+from jaxnet.core import updating_parameters
+
 State = namedtuple('optimizer', ('step', 'values'))
 
 
+def _updated(parameters, updates):
+    """Returns `parameters` with `updates` from `updating_parameters` applied,
+    and a tree of flags like `parameters` that are set for updated parameters."""
+    leaves, treedef = tree_flatten(parameters)
+    return (tree_unflatten(treedef, [updates.get(i, leaf) for i, leaf in enumerate(leaves)]),
+            tree_unflatten(treedef, [i in updates for i in range(len(leaves))]))
+
+
+def _accumulated(value_and_grad, microbatches, concatenated_aux=False):
+    """Splits inputs along their first dimension into `microbatches` parts
+    and returns the mean of loss (or loss and auxiliary data) and gradients over them.
+    Microbatches are processed sequentially via `lax.scan`, accumulating gradients in one buffer,
+    so that peak memory for activations is that of a single microbatch.
+    A given random `key` is split to provide a distinct key for each microbatch.
+    If `concatenated_aux`, auxiliary data is a pair of data to average and data to concatenate
+    along the first dimension, like the carry of recurrent nets."""
+
+    def split(x):
+        if x.shape[0] % microbatches:
+            raise ValueError(f'Batch size {x.shape[0]} is not divisible '
+                             f'by the number of microbatches ({microbatches}).')
+
+        return np.reshape(x, (microbatches, x.shape[0] // microbatches) + x.shape[1:])
+
+    def accumulated(params, *inputs, **kwargs):
+        key = kwargs.pop('key', None)
+        keys = None if key is None else random.split(key, microbatches)
+
+        def loss_and_gradient(inputs, key):
+            return value_and_grad(params, *inputs,
+                                  **(kwargs if key is None else dict(kwargs, key=key)))
+
+        def summand_and_concatenated(inputs, key):
+            summand = loss_and_gradient(inputs, key)
+            if not concatenated_aux:
+                return summand, None
+
+            (loss, (aux, concatenated)), gradient = summand
+            return ((loss, aux), gradient), concatenated
+
+        def accumulate(sums, inputs_and_key):
+            summand, concatenated = summand_and_concatenated(*inputs_and_key)
+            return tree_multimap(np.add, sums, summand), concatenated
+
+        # The first microbatch initializes the sums, since gradients are not necessarily
+        # structured like the parameters (i. e. for frozen parameters of `Partitioned`):
+        inputs_and_keys = tree_map(split, inputs), keys
+        first, first_concatenated = summand_and_concatenated(
+            *tree_map(lambda x: x[0], inputs_and_keys))
+        sums, concatenated = lax.scan(accumulate, first,
+                                      tree_map(lambda x: x[1:], inputs_and_keys))
+        means = tree_map(lambda x: x / microbatches, sums)
+        if not concatenated_aux:
+            return means
+
+        (loss, aux), gradient = means
+        concatenated = tree_multimap(
+            lambda x, xs: np.reshape(np.concatenate((x[np.newaxis], xs)), (-1,) + x.shape[1:]),
+            first_concatenated, concatenated)
+        return (loss, (aux, concatenated)), gradient
+
+    return accumulated
+
+
 class Optimizer(ABC):
     """
     Optimizes parameters based on their gradients.
     The optimizer state consists of a time step and
-    a non-nested (named)tuple of numpy arrays for each parameter,
+    a (named)tuple of numpy arrays for each parameter,
     arranged in a tree like the parameters themselves.
     """
 
-    def init(self, parameters):
-        return State(0, tree_map(self._init_for_parameter, parameters))
+    @property
+    def _parameters_treedefs(self):
+        """Tree structures of parameters by tree structure of state values, populated by `init`.
+        Created lazily, so that subclasses are not required to call `__init__`."""
+        return self.__dict__.setdefault('_parameters_treedefs_by_values', {})
+
+    def init(self, parameters, updated=None):
+        """`updated` is a tree of flags like `parameters`, as returned by `updated_parameters`,
+        marking parameters that are updated via `update_parameter` instead of being trained,
+        i. e. running statistics. These are kept in the state without optimizer state."""
+        leaves, treedef = tree_flatten(parameters)
+        is_updated = [False] * len(leaves) if updated is None else tree_leaves(updated)
+        values = tree_unflatten(treedef, [
+            _Updated(parameter) if parameter_updated else self._init_for_parameter(parameter)
+            for parameter, parameter_updated in zip(leaves, is_updated)])
+        self._parameters_treedefs[tree_structure(values)] = treedef
+        return State(0, values)
 
     def update_from_gradients(self, gradients, state):
         step, _state = state
-        return State(step + 1,
-                     tree_multimap(partial(self._update_for_parameter, step), gradients, _state))
+        return State(step + 1, tree_multimap(partial(self._update_state, step), gradients, _state))
+
+    def _update_state(self, step, gradient, state):
+        if isinstance(state, _Updated):
+            return state
+
+        return self._update_for_parameter(step, gradient, state)
 
     def get_parameters(self, state):
-        _, state = state
+        _, values = state
+        treedef = self._parameters_treedef(values)
+        return tree_unflatten(treedef, map(self._parameter_of, treedef.flatten_up_to(values)))
+
+    def _parameter_of(self, state):
+        if isinstance(state, _Updated):
+            return state.parameter
+
+        return self._get_parameter(state)
 
-        def _get_parameters(state):
-            # assumes state is non-nested (named)tuple of numpy arrays for each parameter:
-            if all(map(lambda n: isinstance(n, jax.numpy.ndarray), state)) and len(state) > 0:
-                return self._get_parameter(state)
+    def _parameters_treedef(self, values):
+        values_treedef = tree_structure(values)
+        treedef = self._parameters_treedefs.get(values_treedef)
+        if treedef is None:
+            # state was not created by `init` of this optimizer, i. e. loaded from disk:
+            treedef = tree_structure(self._get_parameters_recursively(values))
+            self._parameters_treedefs[values_treedef] = treedef
 
-            # TODO assumes parameters to be a nested (named)tuple / list:
-            return type(state)(*map(_get_parameters, state))
+        return treedef
 
-        return _get_parameters(state)
+    def _get_parameters_recursively(self, values):
+        # assumes the state of each parameter to be a namedtuple of arrays:
+        if isinstance(values, tuple) and len(values) > 0 and \
+                all(isinstance(v, (jax.numpy.ndarray, Quantized)) for v in values):
+            return self._parameter_of(values)
+
+        # assumes parameters to be a pytree, traversed like in `jax.tree_util`:
+        handler = _pytree_registry.get(type(values))
+        if handler:
+            children, metadata = handler.to_iter(values)
+            parameters = list(map(self._get_parameters_recursively, children))
+            return handler.from_iter(metadata, parameters)
+
+        if isinstance(values, tuple) and hasattr(values, '_fields'):
+            return type(values)(*map(self._get_parameters_recursively, values))
+
+        raise ValueError(f'Unexpected optimizer state {values}.')
 
     def get_step(self, state):
         step, _ = state
         return step
 
-    def update(self, loss_fun, state, *inputs, jit=False, **kwargs):
-        return self._update(loss_fun, state, *inputs, jit=jit, **kwargs)
+    def update(self, loss_fun, state, *inputs, jit=False, microbatches=1, **kwargs):
+        """Parameters that `loss_fun` updates via `update_parameter` are replaced
+        along with applied steps, see `init` to keep them without optimizer state."""
+        return self._update(loss_fun, state, *inputs, jit=jit, microbatches=microbatches,
+                            **kwargs)
 
-    def update_and_get_loss(self, loss_fun, state, *inputs, jit=False, **kwargs):
-        return self._update(loss_fun, state, *inputs, **kwargs, jit=jit, return_loss=True)
+    def update_and_get_loss(self, loss_fun, state, *inputs, jit=False, microbatches=1, **kwargs):
+        return self._update(loss_fun, state, *inputs, **kwargs, jit=jit,
+                            microbatches=microbatches, return_loss=True)
 
-    def _update(self, loss_fun, state, *inputs, jit=False, return_loss=False, **kwargs):
-        inner = self._update_fun(loss_fun, return_loss=return_loss)
+    def _update(self, loss_fun, state, *inputs, jit=False, microbatches=1, return_loss=False,
+                **kwargs):
+        inner = self._update_fun(loss_fun, return_loss=return_loss, microbatches=microbatches)
         return (jax.jit(inner) if jit else inner)(state, *inputs, **kwargs)
 
     # To avoid recompilation on every call:
     @lru_cache()
-    def _update_fun(self, loss_fun, return_loss=False):
+    def _update_fun(self, loss_fun, return_loss=False, microbatches=1):
         def update(state, *inputs, **kwargs):
             params = self.get_parameters(state)
-            if return_loss:
-                loss, gradient = value_and_grad(loss_fun)(params, *inputs, **kwargs)
-                return self.update_from_gradients(gradient, state), loss
-            else:
-                gradient = grad(loss_fun)(params, *inputs, **kwargs)
-                return self.update_from_gradients(gradient, state)
+            value_and_grad = self._value_and_grad(updating_parameters(loss_fun), state,
+                                                  has_aux=True)
+            if microbatches > 1:
+                value_and_grad = _accumulated(value_and_grad, microbatches)
+
+            (loss, updates), gradient = value_and_grad(params, *inputs, **kwargs)
+            new_state = self._with_updated_parameters(
+                self.update_from_gradients(gradient, state), state, params, updates)
+            return (new_state, loss) if return_loss else new_state
 
         return update
 
+    def _with_updated_parameters(self, new_state, state, parameters, updates):
+        """Replaces `parameters` in `new_state` by `updates` from `updating_parameters`."""
+        if not updates:
+            return new_state
+
+        # steps skipped by `LossScaled` are not counted and do not update parameters:
+        applied = new_state.step > state.step
+        leaves = tree_leaves(parameters)
+        updates = {i: np.where(applied, value, leaves[i]) for i, value in updates.items()}
+        return self._replaced_parameters(new_state, *_updated(parameters, updates))
+
+    def update_many(self, loss_fun, state, dataset_arrays, num_steps, batch_size, key,
+                    randomized=False):
+        """Runs `num_steps` updates inside a single compiled `lax.scan`.
+        Batches of `batch_size` examples are sliced on device from `dataset_arrays`,
+        arrays with a leading example dimension (like inputs and targets).
+        Examples are shuffled at the beginning of each epoch using `key`,
+        remaining examples that do not fill a batch are skipped.
+        If `randomized`, a distinct random key is passed to `loss_fun` for each step via `key`.
+        Returns the new state and an array of the losses of all steps."""
+        dataset_arrays = tuple(dataset_arrays)
+        if np.shape(dataset_arrays[0])[0] < batch_size:
+            raise ValueError('Dataset must contain at least one batch.')
+
+        update_many = self._update_many_fun(loss_fun, num_steps, batch_size, randomized)
+        return update_many(state, dataset_arrays, key)
+
+    @lru_cache()
+    def _update_many_fun(self, loss_fun, num_steps, batch_size, randomized):
+        update = self._update_fun(loss_fun, return_loss=True)
+
+        @jax.jit
+        def update_many(state, dataset_arrays, key):
+            example_count = dataset_arrays[0].shape[0]
+            batch_count = example_count // batch_size
+            shuffle_key, loss_key = random.split(key)
+
+            def shuffled_indices(epoch):
+                return random.shuffle(random.fold_in(shuffle_key, epoch), np.arange(example_count))
+
+            def step(carry, i):
+                state, indices = carry
+                epoch, batch = i // batch_count, i % batch_count
+                indices = lax.cond(batch == 0, epoch, shuffled_indices, indices, lambda x: x)
+                batch_indices = lax.dynamic_slice_in_dim(indices, batch * batch_size, batch_size)
+                inputs = [np.take(array, batch_indices, axis=0) for array in dataset_arrays]
+                kwargs = {'key': random.fold_in(loss_key, i)} if randomized else {}
+                state, loss = update(state, *inputs, **kwargs)
+                return (state, indices), loss
+
+            (state, _), losses = lax.scan(step, (state, np.arange(example_count)),
+                                          np.arange(num_steps))
+            return state, losses
+
+        return update_many
+
+    def update_truncated(self, loss_fun, state, carry, sequences, window, microbatches=1,
+                         **kwargs):
+        """Truncated backpropagation through time for recurrent nets on long sequences:
+        Splits `sequences`, arrays of shape (batch, time, ...) like inputs and targets, into
+        windows of `window` time steps, and runs one update per window inside a single compiled
+        `lax.scan` over windows. `loss_fun(parameters, carry, *windows, **kwargs)` returns the loss
+        and the final carry of the given windows, i. e. from an `Rnn` with `return_carry=True`.
+        The carry is passed on to the next window, without propagating gradients through it.
+        A given random `key` is split to provide a distinct key for each window.
+        With `microbatches`, each window is split along the batch dimension (as is the carry),
+        see `update`. Parameters that `loss_fun` updates via `update_parameter` are replaced
+        after each window.
+        Returns the new state, the final carry and an array of the losses of all windows."""
+        sequences = tuple(sequences)
+        length = np.shape(sequences[0])[1]
+        if length % window:
+            raise ValueError(f'Sequence length {length} is not divisible by window {window}.')
+
+        update_truncated = self._update_truncated_fun(loss_fun, window, microbatches)
+        return update_truncated(state, carry, sequences, **kwargs)
+
+    @lru_cache()
+    def _update_truncated_fun(self, loss_fun, window, microbatches=1):
+        @jax.jit
+        def update_truncated(state, carry, sequences, **kwargs):
+            key = kwargs.pop('key', None)
+
+            def windowed(x):
+                windows = np.reshape(x, (x.shape[0], x.shape[1] // window, window) + x.shape[2:])
+                return np.swapaxes(windows, 0, 1)
+
+            def window_loss(parameters, carry, *windows, **kwargs):
+                (loss, carry), updates = updating_parameters(loss_fun)(
+                    parameters, carry, *windows, **kwargs)
+                return loss, (updates, carry)
+
+            def step(state_and_carry, i_and_windows):
+                state, carry = state_and_carry
+                i, windows = i_and_windows
+                params = self.get_parameters(state)
+                value_and_grad = self._value_and_grad(window_loss, state, has_aux=True)
+                if microbatches > 1:
+                    value_and_grad = _accumulated(value_and_grad, microbatches,
+                                                  concatenated_aux=True)
+
+                (loss, (updates, carry)), gradients = value_and_grad(
+                    params, lax.stop_gradient(carry), *windows,
+                    **(kwargs if key is None else dict(kwargs, key=random.fold_in(key, i))))
+                new_state = self._with_updated_parameters(
+                    self.update_from_gradients(gradients, state), state, params, updates)
+                return (new_state, carry), loss
+
+            windows = tuple(map(windowed, sequences))
+            (state, carry), losses = lax.scan(step, (state, carry),
+                                              (np.arange(windows[0].shape[0]), windows))
+            return state, carry, losses
+
+        return update_truncated
+
+    def _value_and_grad(self, loss_fun, state, has_aux=False):
+        """Returns a function that evaluates the loss and the gradients
+        to be passed to `update_from_gradients` for the given state.
+        If `has_aux`, `loss_fun` returns a pair of loss and auxiliary data, which is returned
+        in place of the loss, as for `jax.value_and_grad`."""
+        return value_and_grad(loss_fun, has_aux=has_aux)
+
+    def _replaced_parameters(self, state, parameters, is_updated):
+        """Replaces the parameters for which `is_updated`, a tree of flags like `parameters`,
+        is set (i. e. running statistics, see `update_parameter`), resetting their state
+        unless they are kept without optimizer state, see `init`."""
+        step, values = state
+        treedef = self._parameters_treedef(values)
+        return State(step, tree_unflatten(treedef, [
+            self._replaced_state(value, parameter) if updated else value
+            for value, parameter, updated in zip(treedef.flatten_up_to(values),
+                                                 tree_leaves(parameters),
+                                                 tree_leaves(is_updated))]))
+
+    def _replaced_state(self, state, parameter):
+        if isinstance(state, _Updated):
+            return _Updated(parameter)
+
+        return self._init_for_parameter(parameter)
+
+    def _map_parameter_states(self, fun, values, *other_values):
+        """Applies `fun` to the state of each trained parameter in `values`, along with the
+        corresponding states in `other_values`, which are structured like `values`."""
+        treedef = self._parameters_treedef(values)
+        return tree_unflatten(treedef, [
+            state if isinstance(state, _Updated) else fun(state, *other_states)
+            for state, *other_states in zip(treedef.flatten_up_to(values),
+                                            *(treedef.flatten_up_to(v) for v in other_values))])
+
     @abstractmethod
     def _init_for_parameter(self, parameter):
         raise NotImplementedError
@@ -84,73 +358,181 @@ class Optimizer(ABC):
 
 _PARAMETER = 'parameter'
 
+# State of a parameter that is updated via `update_parameter` instead of being trained:
+_Updated = namedtuple('updated', (_PARAMETER,))
+
+
+def _decayed(parameter, previous_parameter, step_size, weight_decay):
+    """Decoupled weight decay (Loshchilov & Hutter, 2019, https://arxiv.org/abs/1711.05101),
+    applied directly to the updated parameter instead of through the gradient."""
+    return parameter - step_size * weight_decay * previous_parameter
+
 
 class Sgd(Optimizer):
     ParameterState = namedtuple('sgd', (_PARAMETER,))
 
-    def __init__(self, step_size=0.01):
+    def __init__(self, step_size=0.01, weight_decay=0.):
+        super().__init__()
         self.step_size = experimental.make_schedule(step_size)
+        self.weight_decay = weight_decay
 
     def _init_for_parameter(self, parameter):
         return self.ParameterState(parameter)
 
     def _update_for_parameter(self, step, gradient, state):
-        return self.ParameterState(self._get_parameter(state) - self.step_size(step) * gradient)
+        parameter = self._get_parameter(state)
+        updated_parameter = parameter - self.step_size(step) * gradient
+        if self.weight_decay:
+            updated_parameter = _decayed(updated_parameter, parameter, self.step_size(step),
+                                         self.weight_decay)
+
+        return self.ParameterState(updated_parameter)
 
     def _get_parameter(self, state):
         parameter, = state
         return parameter
 
 
+Quantized = namedtuple('quantized', ('values', 'scales'))
+
+
+def _quantize(x, block_size, exponent=1):
+    """Block-wise quantization to int8, with one float32 scale (the maximum magnitude) per block.
+    Levels are linear in the `exponent`-th root of magnitudes, i. e. denser near zero for
+    `exponent > 1`, preserving small entries in blocks of a high dynamic range."""
+    flat = np.ravel(x).astype(np.float32)
+    block_size = min(block_size, max(flat.size, 1))
+    blocks = np.reshape(np.pad(flat, (0, -flat.size % block_size)), (-1, block_size))
+    scales = np.max(np.abs(blocks), 1)
+    normalized = blocks / np.where(scales == 0, 1, scales)[:, None]
+    values = np.round(127 * np.sign(normalized) * np.abs(normalized) ** (1 / exponent))
+    return Quantized(values.astype(np.int8), scales)
+
+
+def _dequantize(quantized, shape, dtype, exponent=1, floor=0.):
+    """Inverse of `_quantize`. Magnitudes are at least that of level `floor` (out of 127),
+    i. e. `.5` restores entries rounded to 0 as the largest magnitude that rounds to 0."""
+    values, scales = quantized
+    levels = values.astype(np.float32) / 127
+    magnitudes = np.maximum(np.abs(levels), floor / 127) ** exponent
+    flat = np.ravel(np.where(levels < 0, -magnitudes, magnitudes) * scales[:, None])
+    return np.reshape(flat[:int(onp.prod(shape))], shape).astype(dtype)
+
+
+_SECOND_MOMENTS = ('g_sq', 'avg_sq_grad', 'v')
+# Second moments (divisors of updates) are quantized as their fourth root, and entries rounded
+# to 0 are restored as the largest value that rounds to 0, so that updates stay bounded:
+_SECOND_MOMENT_EXPONENT = 4
+_SECOND_MOMENT_FLOOR = .5
+
+
 class OptimizerFromExperimental(Optimizer):
     """ Wrapper for those JAX' experimental optimizers
-    that already use a non-nested tuple of numpy arrays per parameter as state."""
+    that already use a non-nested tuple of numpy arrays per parameter as state.
+
+    State components other than the parameter itself (i. e. moments) are stored
+    with `moment_dtype` if specified, for example `np.bfloat16`.
+    For `np.int8`, they are quantized block-wise, with a scale for each block of `block_size`
+    entries. Second moments are quantized nonlinearly (as their fourth root) to preserve small
+    entries of blocks with a high dynamic range.
+    Moments are restored to the parameter dtype inside the update.
+
+    With `weight_decay`, parameters additionally decay by `step_size * weight_decay` per step,
+    decoupled from the gradient-based update (as in AdamW)."""
 
-    def __init__(self, experimental_optimizer, *args, state_component_names):
+    def __init__(self, experimental_optimizer, step_size, *args, state_component_names,
+                 moment_dtype=None, block_size=256, weight_decay=0.):
+        super().__init__()
         self._state_component_names = state_component_names
         self._inner_init, self._inner_update, self._inner_get_parameter = \
-            experimental_optimizer.__wrapped__(*args)
+            experimental_optimizer.__wrapped__(step_size, *args)
 
         self.ParameterState = namedtuple(experimental_optimizer.__name__,
                                          state_component_names)
+        self.step_size = experimental.make_schedule(step_size)
+        self.weight_decay = weight_decay
+        self.moment_dtype = None if moment_dtype is None else onp.dtype(moment_dtype)
+        self.block_size = block_size
+
+    def _compress(self, name, component):
+        if self.moment_dtype is None or name == _PARAMETER:
+            return component
+
+        if self.moment_dtype != onp.int8:
+            return component.astype(self.moment_dtype)
+
+        if name in _SECOND_MOMENTS:
+            return _quantize(component, self.block_size, exponent=_SECOND_MOMENT_EXPONENT)
+
+        return _quantize(component, self.block_size)
+
+    def _decompress(self, name, component, parameter):
+        if self.moment_dtype is None or name == _PARAMETER:
+            return component
+
+        if self.moment_dtype != onp.int8:
+            return component.astype(parameter.dtype)
+
+        if name in _SECOND_MOMENTS:
+            return _dequantize(component, parameter.shape, parameter.dtype,
+                               exponent=_SECOND_MOMENT_EXPONENT, floor=_SECOND_MOMENT_FLOOR)
+
+        return _dequantize(component, parameter.shape, parameter.dtype)
 
     def _init_for_parameter(self, parameter):
-        return self.ParameterState(*self._inner_init(parameter))
+        return self.ParameterState(*map(self._compress, self._state_component_names,
+                                        self._inner_init(parameter)))
 
     def _update_for_parameter(self, step, gradient, state):
-        return self.ParameterState(*self._inner_update(step, gradient, state))
+        parameter = self._get_parameter(state)
+        state = tuple(self._decompress(name, component, parameter)
+                      for name, component in zip(self._state_component_names, state))
+        updated_parameter, *moments = self._inner_update(step, gradient, state)
+        if self.weight_decay:
+            updated_parameter = _decayed(updated_parameter, parameter, self.step_size(step),
+                                         self.weight_decay)
+
+        return self.ParameterState(*map(self._compress, self._state_component_names,
+                                        (updated_parameter, *moments)))
 
     def _get_parameter(self, state):
         return self._inner_get_parameter(state)
 
 
-def Momentum(step_size, mass):
+def Momentum(step_size, mass, moment_dtype=None, weight_decay=0.):
     return OptimizerFromExperimental(experimental.momentum, step_size, mass,
-                                     state_component_names=(_PARAMETER, 'velocity'))
+                                     state_component_names=(_PARAMETER, 'velocity'),
+                                     moment_dtype=moment_dtype, weight_decay=weight_decay)
 
 
-def Adagrad(step_size=0.001, momentum=0.9):
+def Adagrad(step_size=0.001, momentum=0.9, moment_dtype=None, weight_decay=0.):
     return OptimizerFromExperimental(experimental.adagrad, step_size, momentum,
-                                     state_component_names=(_PARAMETER, 'g_sq', 'm'))
+                                     state_component_names=(_PARAMETER, 'g_sq', 'm'),
+                                     moment_dtype=moment_dtype, weight_decay=weight_decay)
 
 
-def RmsProp(step_size, gamma=0.9, eps=1e-8):
+def RmsProp(step_size, gamma=0.9, eps=1e-8, moment_dtype=None, weight_decay=0.):
     return OptimizerFromExperimental(experimental.rmsprop, step_size, gamma, eps,
-                                     state_component_names=(_PARAMETER, 'avg_sq_grad'))
+                                     state_component_names=(_PARAMETER, 'avg_sq_grad'),
+                                     moment_dtype=moment_dtype, weight_decay=weight_decay)
 
 
-def RmsPropMomentum(step_size, gamma=0.9, eps=1e-8, momentum=0.9):
+def RmsPropMomentum(step_size, gamma=0.9, eps=1e-8, momentum=0.9, moment_dtype=None,
+                    weight_decay=0.):
     return OptimizerFromExperimental(experimental.rmsprop_momentum, step_size, gamma, eps, momentum,
-                                     state_component_names=(_PARAMETER, 'avg_sq_grad', 'momentum'))
+                                     state_component_names=(_PARAMETER, 'avg_sq_grad', 'momentum'),
+                                     moment_dtype=moment_dtype, weight_decay=weight_decay)
 
 
-def Adam(step_size=0.001, b1=0.9, b2=0.999, eps=1e-8):
+def Adam(step_size=0.001, b1=0.9, b2=0.999, eps=1e-8, moment_dtype=None, weight_decay=0.):
     return OptimizerFromExperimental(experimental.adam, step_size, b1, b2, eps,
-                                     state_component_names=(_PARAMETER, 'm', 'v'))
+                                     state_component_names=(_PARAMETER, 'm', 'v'),
+                                     moment_dtype=moment_dtype, weight_decay=weight_decay)
 
 
 class Sm3(Optimizer):
     def __init__(self, step_size, momentum=0.9):
+        super().__init__()
         self._inner_init, self._inner_update, self._inner_get_parameter = \
             experimental.sm3.__wrapped__(step_size, momentum)
 
@@ -169,3 +551,880 @@ class Sm3(Optimizer):
 
     def _get_parameter(self, state):
         return state[0]
+
+
+def _rms(x):
+    return np.sqrt(np.mean(x ** 2))
+
+
+class Adafactor(Optimizer):
+    """Adafactor optimizer (Shazeer & Stern, 2018, https://arxiv.org/abs/1804.04235).
+
+    For parameters with at least two dimensions, of which the last two have at least
+    `factored_minimum_size` entries (i. e. large dense and convolution kernels),
+    the second moment is stored in factored form as running averages over the rows and over the
+    columns of the last two dimensions. This reduces the optimizer memory for an m x n kernel
+    from O(mn) to O(m + n).
+    Updates are clipped to a root mean square of at most `clipping_threshold`.
+    If no `step_size` is given, the relative step size `min(1e-2, 1 / sqrt(step))`
+    is scaled by the root mean square of the parameter.
+    Momentum is disabled unless `beta1` is given, since it requires memory of parameter size."""
+
+    def __init__(self, step_size=None, beta1=None, decay_rate=.8, clipping_threshold=1.,
+                 epsilon1=1e-30, epsilon2=1e-3, factored_minimum_size=128):
+        super().__init__()
+        self.step_size = None if step_size is None else experimental.make_schedule(step_size)
+        self.beta1 = beta1
+        self.decay_rate = decay_rate
+        self.clipping_threshold = clipping_threshold
+        self.epsilon1 = epsilon1
+        self.epsilon2 = epsilon2
+        self.factored_minimum_size = factored_minimum_size
+
+    @lru_cache()
+    def ParameterState(self, factored):
+        momentum = ('m',) if self.beta1 else ()
+        second_moment = ('v_row', 'v_col') if factored else ('v',)
+        return namedtuple('adafactor', (_PARAMETER, *momentum, *second_moment))
+
+    def _factored(self, shape):
+        return len(shape) >= 2 and min(shape[-2:]) >= self.factored_minimum_size
+
+    def _init_for_parameter(self, parameter):
+        factored = self._factored(parameter.shape)
+        momentum = (np.zeros_like(parameter),) if self.beta1 else ()
+        shape = parameter.shape
+        second_moment = (np.zeros(shape[:-1], parameter.dtype),
+                         np.zeros(shape[:-2] + shape[-1:], parameter.dtype)) \
+            if factored else (np.zeros_like(parameter),)
+        return self.ParameterState(factored)(parameter, *momentum, *second_moment)
+
+    def _update_for_parameter(self, step, gradient, state):
+        factored = self._factored(gradient.shape)
+        parameter = self._get_parameter(state)
+        t = np.asarray(step + 1, np.float32)
+        beta2 = 1 - t ** -self.decay_rate
+        gradient_sq = gradient ** 2 + self.epsilon1
+
+        if factored:
+            v_row = beta2 * state.v_row + (1 - beta2) * np.mean(gradient_sq, -1)
+            v_col = beta2 * state.v_col + (1 - beta2) * np.mean(gradient_sq, -2)
+            row_factor = v_row / np.mean(v_row, -1, keepdims=True)
+            update = gradient / np.sqrt(row_factor[..., None] * v_col[..., None, :])
+            second_moment = v_row, v_col
+        else:
+            v = beta2 * state.v + (1 - beta2) * gradient_sq
+            update = gradient / np.sqrt(v)
+            second_moment = v,
+
+        update = update / np.maximum(1., _rms(update) / self.clipping_threshold)
+
+        momentum = ()
+        if self.beta1:
+            update = self.beta1 * state.m + (1 - self.beta1) * update
+            momentum = update,
+
+        step_size = self.step_size(step) if self.step_size else \
+            np.minimum(1e-2, 1 / np.sqrt(t)) * np.maximum(self.epsilon2, _rms(parameter))
+
+        return self.ParameterState(factored)(parameter - step_size * update,
+                                             *momentum, *second_moment)
+
+    def _get_parameter(self, state):
+        return state[0]
+
+
+class LayerwiseAdaptive(Optimizer):
+    """Base for optimizers that scale the update direction of each parameter by a trust ratio
+    `trust_coefficient * norm(parameter) / norm(direction)`, as used for large-batch training.
+    Norms are computed for each parameter, or, if `per_module`, jointly for all parameters
+    of the same parametrized module (i. e. those grouped in the same namedtuple).
+    Norms of all parameters are computed together in a vectorized way.
+    With `exclude_vectors`, parameters with less than two dimensions (like biases and
+    batch norm parameters) are excluded from trust ratio scaling and weight decay."""
+
+    def __init__(self, step_size, weight_decay, trust_coefficient, per_module, exclude_vectors):
+        super().__init__()
+        self.step_size = experimental.make_schedule(step_size)
+        self.weight_decay = weight_decay
+        self.trust_coefficient = trust_coefficient
+        self.per_module = per_module
+        self.exclude_vectors = exclude_vectors
+
+    def _excluded(self, parameter):
+        return self.exclude_vectors and np.ndim(parameter) < 2
+
+    def update_from_gradients(self, gradients, state):
+        step, values = state
+        treedef = self._parameters_treedef(values)
+        parameter_states = treedef.flatten_up_to(values)
+        parameters = list(map(self._parameter_of, parameter_states))
+        is_updated = [isinstance(state, _Updated) for state in parameter_states]
+        excluded = [updated or self._excluded(parameter)
+                    for parameter, updated in zip(parameters, is_updated)]
+        directions, moments = unzip2(
+            (np.zeros_like(parameter), None) if updated else
+            self._direction(step, gradient, state, is_excluded)
+            for gradient, state, parameter, updated, is_excluded
+            in zip(treedef.flatten_up_to(gradients), parameter_states, parameters, is_updated,
+                   excluded))
+        ratios = self._trust_ratios(treedef, parameters, directions, excluded)
+        return State(step + 1, tree_unflatten(treedef, [
+            state if updated else self._apply(step, state, direction, ratio, moments)
+            for state, direction, ratio, moments, updated
+            in zip(parameter_states, directions, ratios, moments, is_updated)]))
+
+    def _update_for_parameter(self, step, gradient, state):
+        parameter = self._get_parameter(state)
+        excluded = self._excluded(parameter)
+        direction, moments = self._direction(step, gradient, state, excluded)
+        ratio, = self._trust_ratios(tree_structure(parameter), [parameter], [direction],
+                                    [excluded])
+        return self._apply(step, state, direction, ratio, moments)
+
+    def _trust_ratios(self, treedef, parameters, directions, excluded):
+        if len(parameters) == 0:
+            return []
+
+        group_ids, group_count = self._groups(treedef)
+        squared_norms = np.stack([np.stack([np.sum(np.square(p), dtype=np.float32),
+                                            np.sum(np.square(d), dtype=np.float32)])
+                                  for p, d in zip(parameters, directions)])
+        excluded = onp.array(excluded)
+        squared_norms = np.where(excluded[:, None], 0., squared_norms)
+        group_squared_norms = jax.ops.index_add(np.zeros((group_count, 2)), group_ids,
+                                                squared_norms)
+        parameter_norms, direction_norms = np.sqrt(group_squared_norms[group_ids]).T
+        ratios = np.where((parameter_norms > 0) & (direction_norms > 0),
+                          self.trust_coefficient * parameter_norms / direction_norms, 1.)
+        ratios = np.where(excluded, 1., ratios)
+        return [ratios[i] for i in range(len(parameters))]
+
+    @lru_cache()
+    def _groups(self, treedef):
+        """Returns the group index for each parameter and the number of groups."""
+        count = treedef.num_leaves
+        if not self.per_module:
+            return onp.arange(count), count
+
+        group_ids = onp.zeros(count, onp.int32)
+        group_count = 0
+
+        def assign(node):
+            nonlocal group_count
+            if isinstance(node, int):
+                children = [node]
+            elif isinstance(node, dict):
+                children = list(node.values())
+            elif isinstance(node, (tuple, list)):
+                children = list(node)
+            else:
+                children = tree_leaves(node)
+
+            leaves = [child for child in children if isinstance(child, int)]
+            if leaves:
+                group_ids[leaves] = group_count
+                group_count += 1
+
+            for child in children:
+                if not isinstance(child, int):
+                    assign(child)
+
+        assign(tree_unflatten(treedef, range(count)))
+        return group_ids, group_count
+
+    @abstractmethod
+    def _direction(self, step, gradient, state, excluded):
+        """Returns the update direction and the updated moments (if any) for a parameter."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def _apply(self, step, state, direction, ratio, moments):
+        raise NotImplementedError
+
+    def _get_parameter(self, state):
+        return state[0]
+
+
+class Lars(LayerwiseAdaptive):
+    """Layer-wise adaptive rate scaling (You et al., 2017, https://arxiv.org/abs/1708.03888):
+    Sgd with momentum and weight decay, scaled by trust ratios (see `LayerwiseAdaptive`)."""
+
+    ParameterState = namedtuple('lars', (_PARAMETER, 'velocity'))
+
+    def __init__(self, step_size, momentum=.9, weight_decay=0., trust_coefficient=.001,
+                 per_module=False, exclude_vectors=True):
+        super().__init__(step_size, weight_decay, trust_coefficient, per_module, exclude_vectors)
+        self.momentum = momentum
+
+    def _init_for_parameter(self, parameter):
+        return self.ParameterState(parameter, np.zeros_like(parameter))
+
+    def _direction(self, step, gradient, state, excluded):
+        if self.weight_decay and not excluded:
+            gradient = gradient + self.weight_decay * state.parameter
+
+        return gradient, ()
+
+    def _apply(self, step, state, direction, ratio, moments):
+        velocity = self.momentum * state.velocity + self.step_size(step) * ratio * direction
+        return self.ParameterState(state.parameter - velocity, velocity)
+
+
+class Lamb(LayerwiseAdaptive):
+    """Layer-wise adaptive moments (You et al., 2019, https://arxiv.org/abs/1904.00962):
+    Adam with decoupled weight decay, scaled by trust ratios (see `LayerwiseAdaptive`)."""
+
+    ParameterState = namedtuple('lamb', (_PARAMETER, 'm', 'v'))
+
+    def __init__(self, step_size=0.001, b1=0.9, b2=0.999, eps=1e-6, weight_decay=0.,
+                 per_module=False, exclude_vectors=True):
+        super().__init__(step_size, weight_decay, 1., per_module, exclude_vectors)
+        self.b1 = b1
+        self.b2 = b2
+        self.eps = eps
+
+    def _init_for_parameter(self, parameter):
+        return self.ParameterState(parameter, np.zeros_like(parameter), np.zeros_like(parameter))
+
+    def _direction(self, step, gradient, state, excluded):
+        m = (1 - self.b1) * gradient + self.b1 * state.m
+        v = (1 - self.b2) * gradient ** 2 + self.b2 * state.v
+        m_hat = m / (1 - self.b1 ** (step + 1))
+        v_hat = v / (1 - self.b2 ** (step + 1))
+        direction = m_hat / (np.sqrt(v_hat) + self.eps)
+        if self.weight_decay and not excluded:
+            direction = direction + self.weight_decay * state.parameter
+
+        return direction, (m, v)
+
+    def _apply(self, step, state, direction, ratio, moments):
+        return self.ParameterState(state.parameter - self.step_size(step) * ratio * direction,
+                                   *moments)
+
+
+class OptimizerWrapper(Optimizer):
+    """Base for optimizers that wrap another optimizer.
+    If the wrapper defines a namedtuple `Values`, the state values are of that type, with the
+    values of the wrapped optimizer as its first element, followed by the state that is specific
+    to the wrapper. Otherwise, the state is that of the wrapped optimizer."""
+
+    Values = None
+
+    def __init__(self, optimizer):
+        super().__init__()
+        self.optimizer = optimizer
+
+    def init(self, parameters, updated=None):
+        state = self.optimizer.init(parameters, updated)
+        if self.Values is None:
+            return state
+
+        step, values = state
+        return State(step, self.Values(values, *self._init_wrapper_values(parameters)))
+
+    def _init_wrapper_values(self, parameters):
+        raise NotImplementedError
+
+    def _inner_state(self, state):
+        if self.Values is None:
+            return state
+
+        step, values = state
+        return State(step, values[0])
+
+    def update_from_gradients(self, gradients, state):
+        return self.optimizer.update_from_gradients(gradients, state)
+
+    def get_parameters(self, state, **kwargs):
+        return self.optimizer.get_parameters(self._inner_state(state), **kwargs)
+
+    def _value_and_grad(self, loss_fun, state, has_aux=False):
+        return self.optimizer._value_and_grad(loss_fun, self._inner_state(state), has_aux=has_aux)
+
+    def _replaced_parameters(self, state, parameters, is_updated):
+        step, values = state
+        _, inner_values = self.optimizer._replaced_parameters(
+            self._inner_state(state), parameters, is_updated)
+        if self.Values is None:
+            return State(step, inner_values)
+
+        return State(step, type(values)(inner_values, *values[1:]))
+
+    def _map_parameter_states(self, fun, values, *other_values):
+        if self.Values is None:
+            return self.optimizer._map_parameter_states(fun, values, *other_values)
+
+        return type(values)(self.optimizer._map_parameter_states(
+            fun, values[0], *(v[0] for v in other_values)), *values[1:])
+
+    def _init_for_parameter(self, parameter):
+        return self.optimizer._init_for_parameter(parameter)
+
+    def _update_for_parameter(self, step, gradient, state):
+        return self.optimizer._update_for_parameter(step, gradient, state)
+
+    def _get_parameter(self, state):
+        return self.optimizer._get_parameter(state)
+
+
+def _all_finite(tree):
+    return reduce(np.logical_and, (np.all(np.isfinite(x)) for x in tree_leaves(tree)),
+                  np.array(True))
+
+
+class LossScaled(OptimizerWrapper):
+    """Dynamic loss scaling for training with reduced-precision (e.g. float16) compute.
+
+    The loss is multiplied by the current scale before differentiation,
+    gradients are unscaled before they are passed to the wrapped optimizer.
+    If any gradient is not finite, the update is skipped and the scale is divided by `factor`.
+    After `growth_interval` consecutive finite steps, the scale is multiplied by `factor`.
+    All of this happens inside the (jitted) update, without synchronizing with the host.
+    The step only counts applied updates, skipped steps are counted separately.
+    Scale and counters are part of the optimizer state (and therefore saved along with it)."""
+
+    Values = namedtuple('loss_scaled', ('values', 'scale', 'good_steps', 'skipped_steps'))
+
+    def __init__(self, optimizer, initial_scale=2. ** 15, growth_interval=2000, factor=2.,
+                 min_scale=1.):
+        super().__init__(optimizer)
+        self.initial_scale = initial_scale
+        self.growth_interval = growth_interval
+        self.factor = factor
+        self.min_scale = min_scale
+
+    def _init_wrapper_values(self, parameters):
+        return (np.array(self.initial_scale, np.float32),
+                np.zeros((), np.int32), np.zeros((), np.int32))
+
+    def get_scale(self, state):
+        return state.values.scale
+
+    def get_skipped_steps(self, state):
+        return state.values.skipped_steps
+
+    def _value_and_grad(self, loss_fun, state, has_aux=False):
+        scale = state.values.scale
+
+        def scaled(value, factor):
+            if not has_aux:
+                return value * factor
+
+            loss, aux = value
+            return loss * factor, aux
+
+        def scaled_loss_fun(*args, **kwargs):
+            return scaled(loss_fun(*args, **kwargs), scale)
+
+        scaled_value_and_grad = super()._value_and_grad(scaled_loss_fun, state, has_aux=has_aux)
+
+        def value_and_grad(*args, **kwargs):
+            scaled_value, scaled_gradients = scaled_value_and_grad(*args, **kwargs)
+            return scaled(scaled_value, 1 / scale), scaled_gradients
+
+        return value_and_grad
+
+    def update_from_gradients(self, gradients, state):
+        """Expects gradients of the scaled loss, as returned by `_value_and_grad`."""
+        step, values = state
+        gradients = tree_map(lambda g: (g / values.scale).astype(g.dtype), gradients)
+        finite = _all_finite(gradients)
+
+        new_step, new_inner_values = self.optimizer.update_from_gradients(
+            gradients, self._inner_state(state))
+
+        def where_finite(new, old):
+            return np.where(finite, new, old)
+
+        inner_values = tree_multimap(where_finite, new_inner_values, values.values)
+        good_steps = where_finite(values.good_steps + 1, 0)
+        grow = good_steps >= self.growth_interval
+        scale = where_finite(np.where(grow, values.scale * self.factor, values.scale),
+                             np.maximum(values.scale / self.factor, self.min_scale))
+        good_steps = np.where(grow, 0, good_steps)
+        skipped_steps = where_finite(values.skipped_steps, values.skipped_steps + 1)
+
+        return State(where_finite(new_step, step),
+                     self.Values(inner_values, scale.astype(np.float32), good_steps,
+                                 skipped_steps))
+
+
+def _is_elementwise(optimizer):
+    if isinstance(optimizer, Vectorized):
+        # the factory is only known to be non-elementwise if it is an optimizer class:
+        return not isinstance(optimizer.optimizer, type) or \
+               not issubclass(optimizer.optimizer, _non_elementwise_optimizers)
+
+    return not isinstance(optimizer, _non_elementwise_optimizers)
+
+
+class Fused(Optimizer):
+    """Runs the update of an optimizer with elementwise updates (like `Sgd`, `Momentum` or `Adam`)
+    on a few flat buffers instead of on each parameter separately:
+    All parameters of the same dtype (and their optimizer state components) are packed into one
+    contiguous buffer, so that each step takes a few vectorized operations,
+    independent of the number of parameters.
+    This speeds up models with many small parameters, like biases or batch norm scales.
+    Parameters are unpacked via slicing and reshaping, which XLA fuses into consuming operations
+    when jitted.
+    The buffer layout is determined by `init`, so use one instance per parameter structure.
+    For a `Vectorized` optimizer, buffers keep the leading replica axis.
+    Optimizers with updates that depend on the shape of parameters (like `Sm3`, `Adafactor`,
+    `Lamb` or `Lars`) and wrappers are not supported."""
+
+    def __init__(self, optimizer):
+        if not _is_elementwise(optimizer):
+            raise ValueError(f'{type(optimizer).__name__} does not update parameters elementwise '
+                             f'and cannot be fused.')
+
+        super().__init__()
+        self.optimizer = optimizer
+        self._layout = None
+        # number of leading axes that are kept when packing, i. e. the replica axis:
+        self._batch_ndim = 1 if isinstance(optimizer, Vectorized) else 0
+
+    def init(self, parameters, updated=None):
+        if any(tree_leaves(updated)):
+            raise ValueError('Fused does not keep parameters without optimizer state, '
+                             'exclude them via `Partitioned` instead.')
+
+        leaves, treedef = tree_flatten(parameters)
+        dtypes = sorted(set(map(np.result_type, leaves)), key=str)
+        offsets = [0] * len(dtypes)
+        slots = []
+        for leaf in leaves:
+            group = dtypes.index(np.result_type(leaf))
+            size = int(onp.prod(np.shape(leaf)[self._batch_ndim:]))
+            slots.append((group, offsets[group], size, np.shape(leaf)))
+            offsets[group] += size
+
+        self._layout = treedef, len(dtypes), slots
+        return State(0, tuple(map(self.optimizer._init_for_parameter, self._pack(leaves))))
+
+    def _get_layout(self):
+        if self._layout is None:
+            raise ValueError('Buffer layout is unknown. Call `init` on (example) parameters first.')
+
+        return self._layout
+
+    def _pack(self, leaves):
+        _, group_count, slots = self._get_layout()
+        return [np.concatenate([np.reshape(leaf, np.shape(leaf)[:self._batch_ndim] + (-1,))
+                                for leaf, slot in zip(leaves, slots) if slot[0] == group],
+                               axis=self._batch_ndim) for group in range(group_count)]
+
+    def update_from_gradients(self, gradients, state):
+        step, values = state
+        buffers = self._pack(tree_leaves(gradients))
+        return State(step + 1, tuple(self.optimizer._update_for_parameter(step, gradient, value)
+                                     for gradient, value in zip(buffers, values)))
+
+    def get_parameters(self, state):
+        _, values = state
+        treedef, _, slots = self._get_layout()
+        buffers = list(map(self.optimizer._get_parameter, values))
+        return tree_unflatten(treedef, [np.reshape(buffers[group][..., start:start + size], shape)
+                                        for group, start, size, shape in slots])
+
+    def _value_and_grad(self, loss_fun, state, has_aux=False):
+        return self.optimizer._value_and_grad(loss_fun, state, has_aux=has_aux)
+
+    def _map_parameter_states(self, fun, values, *other_values):
+        return tuple(map(fun, values, *other_values))
+
+    def _replaced_parameters(self, state, parameters, is_updated):
+        step, values = state
+        leaves = tree_leaves(parameters)
+        buffers = self._pack(leaves)
+        masks = self._pack([np.full(np.shape(leaf), updated)
+                            for leaf, updated in zip(leaves, tree_leaves(is_updated))])
+        return State(step, tuple(tree_multimap(partial(np.where, mask),
+                                               self.optimizer._init_for_parameter(buffer), value)
+                                 for mask, buffer, value in zip(masks, buffers, values)))
+
+    def _init_for_parameter(self, parameter):
+        return self.optimizer._init_for_parameter(parameter)
+
+    def _update_for_parameter(self, step, gradient, state):
+        return self.optimizer._update_for_parameter(step, gradient, state)
+
+    def _get_parameter(self, state):
+        return self.optimizer._get_parameter(state)
+
+
+_non_elementwise_optimizers = (Sm3, Adafactor, LayerwiseAdaptive, OptimizerWrapper, Fused)
+
+
+class Averaged(OptimizerWrapper):
+    """Keeps an exponential moving average of the parameters (Polyak averaging) in the
+    optimizer state, updated within the same (jitted) update as the parameters.
+    Use `get_parameters(state, averaged=True)` to obtain the averaged parameters.
+
+    With `bias_correction`, the average is corrected for its initialization (as in Adam),
+    so that it does not lag behind early in training. Until `start_step`, the average
+    follows the parameters. The corrected average is stored directly,
+    so that retrieving it for evaluation requires no computation."""
+
+    Values = namedtuple('averaged', ('values', 'averaged_parameters'))
+
+    def __init__(self, optimizer, decay=.999, bias_correction=True, start_step=0):
+        super().__init__(optimizer)
+        self.decay = decay
+        self.bias_correction = bias_correction
+        self.start_step = start_step
+
+    def _init_wrapper_values(self, parameters):
+        return parameters,
+
+    def get_parameters(self, state, averaged=False, **kwargs):
+        if averaged:
+            return state.values.averaged_parameters
+
+        return super().get_parameters(state, **kwargs)
+
+    def update_from_gradients(self, gradients, state):
+        inner_state = self.optimizer.update_from_gradients(gradients, self._inner_state(state))
+        parameters = self.optimizer.get_parameters(inner_state)
+
+        # number of averaged steps, including the current one:
+        count = np.asarray(inner_state.step - self.start_step, np.float32)
+        weight = 1 - self.decay
+        if self.bias_correction:
+            weight = weight / (1 - self.decay ** np.maximum(count, 1))
+        weight = np.where(count < 1, 1., weight)
+
+        def averaged(average, parameter):
+            return (average + weight * (parameter - average)).astype(average.dtype)
+
+        return State(inner_state.step, self.Values(inner_state.values, tree_multimap(
+            averaged, state.values.averaged_parameters, parameters)))
+
+
+def clip_by_global_norm(max_norm):
+    """Gradient transform that rescales all gradients jointly,
+    such that their global L2 norm is at most `max_norm`."""
+
+    def transform(gradients, parameters):
+        return experimental.clip_grads(gradients, max_norm)
+
+    return transform
+
+
+def clip_by_norm(max_norm):
+    """Gradient transform that rescales the gradient of each parameter separately,
+    such that its L2 norm is at most `max_norm`."""
+
+    def clip(gradient):
+        norm = np.sqrt(np.sum(gradient ** 2))
+        return gradient * np.minimum(1., max_norm / np.maximum(norm, 1e-12))
+
+    def transform(gradients, parameters):
+        return tree_map(clip, gradients)
+
+    return transform
+
+
+def _map_gradients(fun, gradients, parameters):
+    """Maps `fun(gradient, parameter)` over `gradients`, skipping parameters that have
+    no gradients (`None`, i. e. frozen parameters of `Partitioned`)."""
+    if gradients is None:
+        return None
+
+    handler = _pytree_registry.get(type(gradients))
+    if handler:
+        children, metadata = handler.to_iter(gradients)
+        parameter_children, _ = handler.to_iter(parameters)
+        return handler.from_iter(metadata, [_map_gradients(fun, g, p) for g, p
+                                            in zip(children, parameter_children)])
+
+    if isinstance(gradients, tuple) and hasattr(gradients, '_fields'):
+        return type(gradients)(*(_map_gradients(fun, g, p)
+                                 for g, p in zip(gradients, parameters)))
+
+    return fun(gradients, parameters)
+
+
+def l2_penalty(rate):
+    """Gradient transform that adds `rate * parameter` to each gradient.
+    Equivalent to `L2Regularized(loss, scale=rate)`,
+    without an additional pass over all parameters in forward and backward computation.
+    For adaptive optimizers like `Adam`, this is not equivalent to (decoupled) weight decay,
+    see the `weight_decay` option of optimizers and `parameter_decay` of `GradientTransformed`."""
+
+    def transform(gradients, parameters):
+        return _map_gradients(lambda g, p: g + rate * p, gradients, parameters)
+
+    return transform
+
+
+def gradient_centralization():
+    """Gradient transform that subtracts the mean over all but the last (output) dimension
+    from the gradients of parameters with multiple dimensions, such as kernels
+    (Yong et al., 2020, https://arxiv.org/abs/2004.01461)."""
+
+    def centralized(gradient):
+        if np.ndim(gradient) < 2:
+            return gradient
+
+        return gradient - np.mean(gradient, tuple(range(np.ndim(gradient) - 1)), keepdims=True)
+
+    def transform(gradients, parameters):
+        return tree_map(centralized, gradients)
+
+    return transform
+
+
+class GradientTransformed(OptimizerWrapper):
+    """Applies a chain of gradient transforms (like `clip_by_global_norm` or `l2_penalty`)
+    before passing gradients to the wrapped optimizer, within the same (jitted) update.
+    Each transform is a function `(gradients, parameters) -> gradients`.
+    With `parameter_decay` (a constant or a schedule like step sizes), each trained parameter
+    additionally decays by `parameter_decay * parameter` per step, independently of the
+    gradients. This is decoupled weight decay for optimizers without a `weight_decay` option
+    (like `Adafactor`), with `parameter_decay = step_size * weight_decay`.
+    To combine with `LossScaled`, wrap this optimizer, since transforms expect unscaled gradients.
+    """
+
+    def __init__(self, optimizer, *transforms, parameter_decay=0.):
+        super().__init__(optimizer)
+        self.transforms = transforms
+        self.parameter_decay = experimental.make_schedule(parameter_decay) \
+            if parameter_decay else None
+
+    def update_from_gradients(self, gradients, state):
+        parameters = self.get_parameters(state)
+        for transform in self.transforms:
+            gradients = transform(gradients, parameters)
+
+        updated_state = super().update_from_gradients(gradients, state)
+        if self.parameter_decay is None:
+            return updated_state
+
+        previous_step, previous_values = state
+        step, values = updated_state
+        decay = self.parameter_decay(previous_step)
+
+        def decayed(parameter_state, previous_parameter_state):
+            return parameter_state._replace(**{_PARAMETER: _decayed(
+                parameter_state[0], previous_parameter_state[0], 1., decay)})
+
+        return State(step, self._map_parameter_states(decayed, values, previous_values))
+
+
+def _path(path):
+    return tuple(path.split('/')) if isinstance(path, str) else tuple(path)
+
+
+def _subtree(tree, path):
+    for name in path:
+        tree = tree[name] if isinstance(tree, dict) else getattr(tree, name)
+
+    return tree
+
+
+def _replaced(tree, path, subtree):
+    if not path:
+        return subtree
+
+    name, *rest = path
+    if isinstance(tree, dict):
+        return dict(tree, **{name: _replaced(tree[name], rest, subtree)})
+
+    return tree._replace(**{name: _replaced(getattr(tree, name), rest, subtree)})
+
+
+class Partitioned(OptimizerWrapper):
+    """Freezes parts of the parameters or optimizes them with separate optimizers,
+    i. e. with their own step size schedules.
+    `partitions` maps non-overlapping parts of the parameters to an optimizer,
+    or to `None` to freeze them. A part is specified by
+        - its path, a tuple of names (or a string of names separated by '/'),
+          i. e. `('sequential', 'dense0')` or `'sequential/dense0'` for
+          `params.sequential.dense0`, or
+        - a submodule, if `model` is given, i. e. as `loss.shaped(*example_inputs)`.
+    All remaining parameters are optimized by `optimizer`.
+    Frozen parameters are kept in the state as they are, without optimizer state.
+    They are closed over as constants when computing gradients, skipping their backward pass.
+    """
+
+    Values = namedtuple('partitioned', ('values', 'partitions'))
+
+    def __init__(self, optimizer, partitions, model=None):
+        super().__init__(optimizer)
+
+        def path(part):
+            if isinstance(part, (str, tuple, list)):
+                return _path(part)
+
+            if model is None:
+                raise ValueError(f'Specifying {part} by module requires to pass `model`.')
+
+            return model.path_to(part)
+
+        self.paths = tuple(map(path, partitions.keys()))
+        self.partition_optimizers = tuple(partitions.values())
+
+    def _split(self, tree):
+        """Returns the tree with all partitions replaced by `None`, and the partitions."""
+        partitions = []
+        for path in self.paths:
+            partitions.append(_subtree(tree, path))
+            tree = _replaced(tree, path, None)
+
+        return tree, tuple(partitions)
+
+    def _merged(self, tree, partitions):
+        for path, partition in zip(self.paths, partitions):
+            tree = _replaced(tree, path, partition)
+
+        return tree
+
+    def init(self, parameters, updated=None):
+        remaining, partitions = self._split(parameters)
+        remaining_updated, partitions_updated = (None, (None,) * len(self.paths)) \
+            if updated is None else self._split(updated)
+        step, values = self.optimizer.init(remaining, remaining_updated)
+        return State(step, self.Values(values, tuple(
+            partition if optimizer is None else optimizer.init(partition, partition_updated).values
+            for optimizer, partition, partition_updated
+            in zip(self.partition_optimizers, partitions, partitions_updated))))
+
+    def get_parameters(self, state, **kwargs):
+        step, values = state
+        return self._merged(super().get_parameters(state, **kwargs), (
+            partition if optimizer is None else optimizer.get_parameters(State(step, partition))
+            for optimizer, partition in zip(self.partition_optimizers, values.partitions)))
+
+    def _value_and_grad(self, loss_fun, state, has_aux=False):
+        def value_and_grad(parameters, *inputs, **kwargs):
+            remaining, partitions = self._split(parameters)
+            is_frozen = tuple(optimizer is None for optimizer in self.partition_optimizers)
+            frozen = tuple(p if f else None for f, p in zip(is_frozen, partitions))
+            trainable = tuple(None if f else p for f, p in zip(is_frozen, partitions))
+
+            def trainable_loss_fun(trainable_parameters, *inputs, **kwargs):
+                remaining, trainable = trainable_parameters
+                return loss_fun(self._merged(remaining, (
+                    frozen_p if f else trainable_p
+                    for f, frozen_p, trainable_p in zip(is_frozen, frozen, trainable))),
+                                *inputs, **kwargs)
+
+            trainable_value_and_grad = super(Partitioned, self)._value_and_grad(
+                trainable_loss_fun, state, has_aux=has_aux)
+            value, (remaining_gradients, gradients) = trainable_value_and_grad(
+                (remaining, trainable), *inputs, **kwargs)
+            return value, self._merged(remaining_gradients, gradients)
+
+        return value_and_grad
+
+    def update_from_gradients(self, gradients, state):
+        step, values = state
+        remaining_gradients, gradients = self._split(gradients)
+        new_step, remaining_values = self.optimizer.update_from_gradients(
+            remaining_gradients, self._inner_state(state))
+        return State(new_step, self.Values(remaining_values, tuple(
+            partition if optimizer is None else
+            optimizer.update_from_gradients(gradient, State(step, partition)).values
+            for optimizer, gradient, partition
+            in zip(self.partition_optimizers, gradients, values.partitions))))
+
+    def _replaced_parameters(self, state, parameters, is_updated):
+        step, values = state
+        remaining, partitions = self._split(parameters)
+        remaining_is_updated, partitions_is_updated = self._split(is_updated)
+        _, remaining_values = self.optimizer._replaced_parameters(
+            self._inner_state(state), remaining, remaining_is_updated)
+        return State(step, self.Values(remaining_values, tuple(
+            partition if optimizer is None else
+            optimizer._replaced_parameters(State(step, v), partition, updated).values
+            for optimizer, partition, v, updated
+            in zip(self.partition_optimizers, partitions, values.partitions,
+                   partitions_is_updated))))
+
+    def _map_parameter_states(self, fun, values, *other_values):
+        return self.Values(
+            self.optimizer._map_parameter_states(fun, values.values,
+                                                 *(v.values for v in other_values)),
+            tuple(partition if optimizer is None else
+                  optimizer._map_parameter_states(fun, partition, *other_partitions)
+                  for optimizer, partition, *other_partitions
+                  in zip(self.partition_optimizers, values.partitions,
+                         *(v.partitions for v in other_values))))
+
+
+class Vectorized(Optimizer):
+    """Trains a stack of model replicas in one program, i. e. for a sweep over seeds or
+    hyperparameters. Parameters have a leading replica axis, as returned by `init_parameters`
+    for a batch of keys. `optimizer` is a factory like `Adam` that is called with
+    `hyperparameters` for each replica. Arrays with a leading replica axis (i. e. a vector of step
+    sizes) are mapped over, other hyperparameters are shared by all replicas.
+    Updates are `vmap`ped across replicas. Inputs are shared, a given random `key` is split to
+    provide a distinct key for each replica. The returned loss has a replica axis."""
+
+    def __init__(self, optimizer, **hyperparameters):
+        super().__init__()
+        self.optimizer = optimizer
+        self.hyperparameters = hyperparameters
+
+    def _vmap(self, fun, *args):
+        """Maps `fun(optimizer, *args)` over replicas of `args`, given one optimizer per replica."""
+
+        # only arrays are mapped over, others (i. e. schedules or dtypes) are bound statically:
+        mapped = {name: value for name, value in self.hyperparameters.items()
+                  if isinstance(value, np.ndarray) and np.ndim(value) > 0}
+        shared = {name: value for name, value in self.hyperparameters.items()
+                  if name not in mapped}
+
+        def replica_fun(mapped, *args):
+            optimizer = self.optimizer(**shared, **mapped)
+            # share tree structures of parameters between replicas:
+            optimizer.__dict__['_parameters_treedefs_by_values'] = self._parameters_treedefs
+            return fun(optimizer, *args)
+
+        return jax.vmap(replica_fun)(mapped, *args)
+
+    def init(self, parameters, updated=None):
+        return State(0, self._vmap(lambda optimizer, p: optimizer.init(p, updated).values,
+                                   parameters))
+
+    def update_from_gradients(self, gradients, state):
+        step, values = state
+        return State(step + 1, self._vmap(
+            lambda optimizer, g, v: optimizer.update_from_gradients(g, State(step, v)).values,
+            gradients, values))
+
+    def get_parameters(self, state):
+        step, values = state
+        return self._vmap(lambda optimizer, v: optimizer.get_parameters(State(step, v)), values)
+
+    def _replaced_parameters(self, state, parameters, is_updated):
+        step, values = state
+        return State(step, self._vmap(
+            lambda optimizer, v, p: optimizer._replaced_parameters(
+                State(step, v), p, is_updated).values, values, parameters))
+
+    def _value_and_grad(self, loss_fun, state, has_aux=False):
+        step, values = state
+
+        def value_and_grad(parameters, *inputs, **kwargs):
+            key = kwargs.pop('key', None)
+            keys = None if key is None else random.split(key, tree_leaves(parameters)[0].shape[0])
+
+            def replica_value_and_grad(optimizer, v, p, key):
+                return optimizer._value_and_grad(loss_fun, State(step, v), has_aux=has_aux)(
+                    p, *inputs, **(kwargs if key is None else dict(kwargs, key=key)))
+
+            return self._vmap(replica_value_and_grad, values, parameters, keys)
+
+        return value_and_grad
+
+    def _init_for_parameter(self, parameter):
+        return self._vmap(lambda optimizer, p: optimizer._init_for_parameter(p), parameter)
+
+    def _update_for_parameter(self, step, gradient, state):
+        return self._vmap(lambda optimizer, g, s: optimizer._update_for_parameter(step, g, s),
+                          gradient, state)
+
+    def _get_parameter(self, state):
+        return self._vmap(lambda optimizer, s: optimizer._get_parameter(s), state)
@@ -1,11 +1,12 @@
+import jax
 import pytest
 from jax import numpy as np, jit, lax, random
-from jax.nn import relu
+from jax.nn import relu, sigmoid
 from jax.nn.initializers import zeros, normal
 from jax.random import PRNGKey
 
 from jaxnet import parametrized, Dense, Sequential, Conv, flatten, save, load, \
-    parameter, Parameter
+    parameter, Parameter, load_exported, Rnn, GRUCell
 from jaxnet.core import random_key
 from tests.util import random_inputs, assert_parameters_equal, assert_dense_parameters_equal, \
     enable_checks
@@ -440,6 +441,35 @@ def test_scan_parametrized_nonflat_cell():
     assert (3, 2) == outs.shape
 
 
+@pytest.mark.parametrize('remat', (False, True))
+def test_scan_composed_cell(remat):
+    dense = Dense(2)
+
+    @parametrized
+    def cell(carry, x):
+        return relu(carry + x), carry * x
+
+    def step(carry, x):
+        carry, y = cell(carry, dense(x))
+        return carry, y + 1
+
+    @parametrized
+    def rnn(inputs):
+        _, outs = lax.scan(jax.remat(step) if remat else step, np.zeros((1, 2)), inputs)
+        return outs
+
+    inputs = random_inputs((3, 1, 4))
+    params = rnn.init_parameters(inputs, key=PRNGKey(0))
+    assert (4, 2) == params.dense.kernel.shape
+
+    outs = rnn.apply(params, inputs)
+    assert (3, 1, 2) == outs.shape
+    assert np.allclose(outs, rnn.apply(params, inputs, jit=True))
+
+    gradients = jax.grad(lambda params: np.sum(rnn.apply(params, inputs)))(params)
+    assert (4, 2) == gradients.dense.kernel.shape
+
+
 def test_input_dependent_modules():
     @parametrized
     def net(inputs):
@@ -675,6 +705,21 @@ def test_parameters_from_sharing_between_multiple_parents():
     assert np.array_equal(out, out_)
 
 
+def test_path_to():
+    layer = Dense(2)
+    net = Sequential(Dense(2), relu, Sequential(layer, relu), Dense(2))
+    inputs = np.zeros((1, 3))
+    params = net.init_parameters(inputs, key=PRNGKey(0))
+
+    assert ('sequential', 'dense') == net.path_to(layer, inputs)
+    assert ('sequential', 'dense') == net.shaped(inputs).path_to(layer)
+    assert () == net.path_to(net, inputs)
+    assert (2, 2) == params.sequential.dense.kernel.shape
+
+    with pytest.raises(ValueError):
+        net.path_to(Dense(2), inputs)
+
+
 def test_parameter_sharing_between_multiple_parents():
     p = Parameter(lambda key: np.ones(()))
 
@@ -754,6 +799,35 @@ def test_tuple_output_nested():
     outer.init_parameters(np.zeros(()), key=PRNGKey(0))
 
 
+def test_freeze():
+    @parametrized
+    def net(inputs, more_inputs):
+        out = Sequential(Dense(3), relu, Dense(2))(inputs)
+        return out, out + more_inputs
+
+    inputs, more_inputs = random_inputs((1, 4)), random_inputs((1, 2))
+    params = net.init_parameters(inputs, more_inputs, key=PRNGKey(0))
+    out, more_out = net.apply(params, inputs, more_inputs)
+
+    frozen = net.freeze(params, inputs, more_inputs)
+    frozen_out, frozen_more_out = frozen(inputs, more_inputs)
+    assert np.allclose(out, frozen_out)
+    assert np.allclose(more_out, frozen_more_out)
+
+    inputs = 2 * inputs
+    frozen = net.shaped(inputs, more_inputs).freeze(params)
+    assert np.allclose(net.apply(params, inputs, more_inputs)[0], frozen(inputs, more_inputs)[0])
+
+    with pytest.raises(ValueError):
+        frozen(random_inputs((2, 4)), more_inputs)
+
+    with pytest.raises(ValueError):
+        frozen(inputs.astype(np.int32), more_inputs)
+
+    with pytest.raises(ValueError):
+        frozen(inputs)
+
+
 def test_submodule_init_parameters_is_random():
     @parametrized
     def dense():
@@ -766,6 +840,57 @@ def test_submodule_init_parameters_is_random():
     assert not np.array_equal(params.a, params.b)
 
 
+def test_init_parameters_for_batch_of_keys():
+    net = Sequential(Dense(3), relu, Dense(2))
+    inputs = np.zeros((1, 4))
+    keys = random.split(PRNGKey(0), 5)
+    params = net.init_parameters(inputs, key=keys)
+    assert (5, 4, 3) == params.dense0.kernel.shape
+    assert (5, 2) == params.dense1.bias.shape
+
+    for i, key in enumerate(keys):
+        single_params = net.init_parameters(inputs, key=key)
+        assert np.allclose(single_params.dense0.kernel, params.dense0.kernel[i])
+        assert np.allclose(single_params.dense1.bias, params.dense1.bias[i])
+
+    assert not np.allclose(params.dense0.kernel[0], params.dense0.kernel[1])
+
+
+def test_init_parameters_batched():
+    inputs = np.zeros((1, 4))
+    layer = Dense(3)
+    net = Sequential(layer, relu, Dense(2))
+    keys = random.split(PRNGKey(0), 2)
+    params = net.init_parameters_batched(inputs, keys=keys)
+    assert_parameters_equal(net.init_parameters(inputs, key=keys), params)
+    assert_parameters_equal(params, net.shaped(inputs).init_parameters_batched(keys))
+    assert 'sequential' == type(params).__name__
+
+    layer_params = layer.init_parameters(inputs, key=PRNGKey(1))
+    params = net.init_parameters_batched(inputs, keys=keys, reuse={layer: layer_params})
+    assert np.array_equal(np.stack([layer_params.kernel] * 2), params.dense0.kernel)
+
+
+def test_init_parameters_batched_compiled_once():
+    traces = []
+    layer = Dense(2)
+
+    @parametrized
+    def net(inputs):
+        traces.append(inputs)
+        return layer(inputs)
+
+    keys = random.split(PRNGKey(0), 2)
+    params = net.init_parameters_batched(np.zeros((1, 4)), keys=keys)
+    trace_count = len(traces)
+    other_params = net.init_parameters_batched(np.ones((1, 4)), keys=keys)
+    assert trace_count == len(traces)
+    assert_parameters_equal(params, other_params)
+
+    net.init_parameters_batched(np.zeros((1, 3)), keys=keys)
+    assert trace_count < len(traces)
+
+
 def test_rng_injection():
     @parametrized
     def rand():
@@ -776,6 +901,34 @@ def test_rng_injection():
     assert () == out.shape
 
 
+def test_export():
+    net = Sequential(Conv(2, (2, 2)), relu, flatten, Dense(3))
+    inputs = random_inputs((1, 3, 3, 2))
+    params = net.init_parameters(inputs, key=PRNGKey(0))
+
+    from pathlib import Path
+    path = Path('/') / 'tmp' / 'net.exported'
+    net.export(params, path, inputs)
+    exported = load_exported(path)
+
+    assert np.allclose(net.apply(params, inputs), exported(inputs), atol=1e-6)
+    assert np.allclose(net.apply(params, 2 * inputs), exported(2 * inputs), atol=1e-6)
+
+
+@pytest.mark.parametrize('net', (Sequential(Dense(3), sigmoid, Dense(2), sigmoid),
+                                 Rnn(*GRUCell(3, normal()))))
+def test_export_custom_transforms(net):
+    inputs = random_inputs((2, 4, 3))
+    params = net.init_parameters(inputs, key=PRNGKey(0))
+
+    from pathlib import Path
+    path = Path('/') / 'tmp' / 'net.exported'
+    net.export(params, path, inputs)
+    exported = load_exported(path)
+
+    assert np.allclose(net.apply(params, inputs), exported(inputs), atol=1e-6)
+
+
 def test_save_and_load_params():
     params = Dense(2).init_parameters(np.zeros((1, 2)), key=PRNGKey(0))
 
@@ -1,13 +1,16 @@
+import numpy as onp
 import pytest
-from jax import numpy as np, jit, vmap
+from jax import numpy as np, jit, vmap, tree_map, tree_leaves, value_and_grad
 from jax.nn import relu
-from jax.nn.initializers import zeros, ones
+from jax.nn.initializers import zeros, ones, normal
 from jax.random import PRNGKey
 from pytest import raises
 
 from jaxnet import Dense, Sequential, Conv, Conv1D, ConvTranspose, Conv1DTranspose, flatten, \
-    MaxPool, AvgPool, GRUCell, Rnn, SumPool, Dropout, BatchNorm, parametrized, parameter, \
-    Regularized, Reparametrized, L2Regularized, Batched
+    MaxPool, AvgPool, GRUCell, FusedGRUCell, LSTMCell, Rnn, StackedRnn, Bidirectional, SumPool, \
+    Dropout, BatchNorm, parametrized, parameter, Regularized, Reparametrized, L2Regularized, \
+    Batched, Ensemble, rnn_step, length_bucketed_batches, fold_batch_norm, optimizers, \
+    updated_parameters
 from tests.util import random_inputs, assert_parameters_equal, enable_checks
 
 enable_checks()
@@ -156,6 +159,166 @@ def test_Rnn_shape():
     assert np.array_equal(np.zeros((2, 5, 3)), out)
 
 
+def test_FusedGRUCell():
+    inputs = random_inputs((2, 5, 4))
+    rnn = Rnn(*GRUCell(3, normal()))
+    fused_rnn = Rnn(*FusedGRUCell(3, normal()))
+    params = rnn.init_parameters(inputs, key=PRNGKey(0))
+    fused_params = fused_rnn.init_parameters(inputs, key=PRNGKey(0))
+    assert (4, 9) == fused_params.dense.kernel.shape
+    assert (3, 6) == fused_params.gru_cell.gates_kernel.shape
+    assert (3, 3) == fused_params.gru_cell.compute_kernel.shape
+
+    cell = params.gru_cell
+    x_size = inputs.shape[-1]
+    kernels = cell.update_kernel, cell.reset_kernel, cell.compute_kernel
+    fused_params = fused_params._replace(
+        dense=fused_params.dense._replace(
+            kernel=np.concatenate([k[:x_size] for k in kernels], axis=1),
+            bias=np.zeros(9)),
+        gru_cell=fused_params.gru_cell._replace(
+            gates_kernel=np.concatenate([k[x_size:] for k in kernels[:2]], axis=1),
+            compute_kernel=cell.compute_kernel[x_size:]))
+
+    out = rnn.apply(params, inputs)
+    assert (2, 5, 3) == out.shape
+    assert np.allclose(out, fused_rnn.apply(fused_params, inputs), atol=1e-6)
+    assert np.allclose(out, fused_rnn.apply(fused_params, inputs, jit=True), atol=1e-6)
+
+
+def test_LSTMCell():
+    inputs = random_inputs((2, 5, 4))
+    rnn = Rnn(*LSTMCell(3, normal()))
+    params = rnn.init_parameters(inputs, key=PRNGKey(0))
+    assert (4, 12) == params.dense.kernel.shape
+    assert (3, 12) == params.lstm_cell.recurrent_kernel.shape
+
+    out = rnn.apply(params, inputs)
+    assert (2, 5, 3) == out.shape
+    assert np.allclose(out, rnn.apply(params, inputs, jit=True))
+
+
+@pytest.mark.parametrize('length', (1, 5))
+def test_StackedRnn(length):
+    inputs = random_inputs((2, length, 4))
+    cells = LSTMCell(3, normal()), FusedGRUCell(3, normal()), GRUCell(2, normal())
+    rnns = Sequential(*(Rnn(*cell) for cell in cells))
+    stacked_rnn = StackedRnn(*cells)
+    rnns_params = rnns.init_parameters(inputs, key=PRNGKey(0))
+    params = stacked_rnn.init_parameters(inputs, key=PRNGKey(1))
+    assert ('dense0', 'lstm_cell', 'dense1', 'gru_cell0', 'gru_cell1') == params._fields
+
+    params = params._replace(dense0=rnns_params.rnn0.dense, lstm_cell=rnns_params.rnn0.lstm_cell,
+                             dense1=rnns_params.rnn1.dense, gru_cell0=rnns_params.rnn1.gru_cell,
+                             gru_cell1=rnns_params.rnn2.gru_cell)
+    out = rnns.apply(rnns_params, inputs)
+    assert (2, length, 2) == out.shape
+    assert np.allclose(out, stacked_rnn.apply(params, inputs), atol=1e-6)
+    assert np.allclose(out, stacked_rnn.apply(params, inputs, jit=True), atol=1e-6)
+
+
+@pytest.mark.parametrize('stacked', (False, True))
+def test_Rnn_stateful(stacked):
+    inputs = random_inputs((2, 5, 4))
+    cells = LSTMCell(3, normal()), FusedGRUCell(2, normal())
+    rnn = StackedRnn(*cells, return_carry=True) if stacked else \
+        Rnn(*cells[0], return_carry=True)
+    params = rnn.init_parameters(inputs, key=PRNGKey(0))
+    out, carry = rnn.apply(params, inputs)
+    assert (2, 5, 2 if stacked else 3) == out.shape
+
+    out_start, carry_start = rnn.apply(params, inputs[:, :2])
+    out_end, carry_end = rnn.apply(params, inputs[:, 2:], carry_start, jit=True)
+    assert np.allclose(out, np.concatenate((out_start, out_end), axis=1), atol=1e-6)
+    for c, c_ in zip(tree_leaves(carry), tree_leaves(carry_end)):
+        assert np.allclose(c, c_, atol=1e-6)
+
+    step = rnn_step(rnn)
+    carry = None
+    for t in range(inputs.shape[1]):
+        y, carry = step(params, inputs[:, t], carry)
+        assert np.allclose(out[:, t], y, atol=1e-6)
+
+
+@pytest.mark.parametrize('stacked', (False, True))
+def test_Rnn_lengths(stacked):
+    inputs = random_inputs((2, 5, 4))
+    cells = FusedGRUCell(3, normal()), LSTMCell(2, normal())
+    rnn = StackedRnn(*cells, return_carry=True) if stacked else \
+        Rnn(*cells[1], return_carry=True)
+    params = rnn.init_parameters(inputs, key=PRNGKey(0))
+    lengths = np.array([3, 5])
+
+    out, carry = rnn.apply(params, inputs, None, lengths, jit=True)
+    assert (2, 5, 2) == out.shape
+    assert np.array_equal(np.zeros((2, 2)), out[0, 3:])
+
+    short_out, short_carry = rnn.apply(params, inputs[:1, :3])
+    assert np.allclose(short_out[0], out[0, :3], atol=1e-6)
+    for c, c_ in zip(tree_leaves(short_carry), tree_leaves(carry)):
+        assert np.allclose(c[0], c_[0], atol=1e-6)
+
+    full_out, _ = rnn.apply(params, inputs)
+    assert np.allclose(full_out[1], out[1], atol=1e-6)
+
+
+@pytest.mark.parametrize('stacked', (False, True))
+@pytest.mark.parametrize('lengths', (None, np.array([3, 6])))
+@pytest.mark.parametrize('remat_every', (2, 4))
+def test_Rnn_remat(stacked, lengths, remat_every):
+    inputs = random_inputs((2, 6, 4))
+    cells = GRUCell(3, normal()), LSTMCell(2, normal())
+    rnn, remat_rnn = (StackedRnn(*cells, remat_every=k) if stacked else
+                      Rnn(*cells[0], remat_every=k) for k in (None, remat_every))
+    params = rnn.init_parameters(inputs, key=PRNGKey(0))
+    assert_parameters_equal(params, remat_rnn.init_parameters(inputs, key=PRNGKey(0)))
+
+    def loss(rnn):
+        return lambda params: np.sum(rnn.apply(params, inputs, None, lengths) ** 2)
+
+    out, gradients = value_and_grad(loss(rnn))(params)
+    remat_out, remat_gradients = value_and_grad(loss(remat_rnn))(params)
+    assert np.allclose(out, remat_out, atol=1e-6)
+    for g, g_ in zip(tree_leaves(gradients), tree_leaves(remat_gradients)):
+        assert np.allclose(g, g_, atol=1e-6)
+
+
+def test_length_bucketed_batches():
+    sequence_lengths = [3, 1, 7, 2, 9, 4, 4, 10, 5, 6, 8]
+    sequences = [onp.full((length, 2), length, onp.float32) for length in sequence_lengths]
+    batches = list(length_bucketed_batches(sequences, batch_size=3, max_shapes=2, seed=0))
+    assert {(3, 5, 2), (3, 10, 2)} == {inputs.shape for inputs, _ in batches}
+    assert sorted(sequence_lengths) + [0] == sorted(l for _, lengths in batches for l in lengths)
+    for inputs, lengths in batches:
+        for x, length in zip(inputs, lengths):
+            assert onp.all(x[:length] == length) and onp.all(x[length:] == 0)
+
+
+def test_Bidirectional():
+    inputs = random_inputs((2, 5, 4))
+    forward_cell, backward_cell = FusedGRUCell(3, normal()), LSTMCell(2, normal())
+    forward_rnn, backward_rnn = Rnn(*forward_cell), Rnn(*backward_cell)
+    bidirectional = Bidirectional(forward_cell, backward_cell)
+    forward_params = forward_rnn.init_parameters(inputs, key=PRNGKey(0))
+    backward_params = backward_rnn.init_parameters(inputs, key=PRNGKey(1))
+    params = bidirectional.init_parameters(inputs, key=PRNGKey(2))
+    params = params._replace(dense0=forward_params.dense, dense1=backward_params.dense,
+                             gru_cell=forward_params.gru_cell, lstm_cell=backward_params.lstm_cell)
+
+    out = bidirectional.apply(params, inputs)
+    assert (2, 5, 5) == out.shape
+    backward_out = np.flip(backward_rnn.apply(backward_params, np.flip(inputs, 1)), 1)
+    assert np.allclose(forward_rnn.apply(forward_params, inputs), out[:, :, :3], atol=1e-6)
+    assert np.allclose(backward_out, out[:, :, 3:], atol=1e-6)
+    assert np.allclose(out, bidirectional.apply(params, inputs, jit=True), atol=1e-6)
+
+    lengths = np.array([3, 5])
+    out = bidirectional.apply(params, inputs, lengths)
+    assert np.array_equal(np.zeros((2, 5)), out[0, 3:])
+    assert np.allclose(bidirectional.apply(params, inputs[:1, :3])[0], out[0, :3], atol=1e-6)
+    assert np.allclose(bidirectional.apply(params, inputs)[1], out[1], atol=1e-6)
+
+
 @pytest.mark.parametrize('center', (False, True))
 @pytest.mark.parametrize('scale', (False, True))
 def test_BatchNorm_shape_NHWC(center, scale):
@@ -190,6 +353,147 @@ def test_BatchNorm_shape_NCHW(center, scale):
         assert params.gamma.shape == (5,)
 
 
+@pytest.mark.parametrize('opt', [optimizers.Sgd(0.), optimizers.Fused(optimizers.Adam(0.)),
+                                 optimizers.Partitioned(optimizers.Sgd(0.),
+                                                        {'batch_norm/gamma': None})])
+def test_BatchNorm_running_statistics(opt):
+    inputs = random_inputs((4, 3))
+    batch_norm = BatchNorm(axis=(0,), momentum=.5)
+
+    @parametrized
+    def loss(inputs):
+        return np.sum(batch_norm(inputs))
+
+    params = loss.init_parameters(inputs, key=PRNGKey(0))
+    assert np.array_equal(np.zeros(3), params.batch_norm.mean)
+    assert np.array_equal(np.ones(3), params.batch_norm.var)
+
+    state = opt.update(loss.apply, opt.init(params), inputs, jit=True)
+    params = opt.get_parameters(state).batch_norm
+    mean, var = np.mean(inputs, 0), np.var(inputs, 0)
+    assert np.allclose(.5 * mean, params.mean)
+    assert np.allclose(.5 + .5 * var, params.var)
+    assert np.array_equal(np.ones(3), params.gamma)
+
+    test_batch_norm = BatchNorm(axis=(0,), momentum=.5, test_mode=True)
+    out = test_batch_norm.apply(params, inputs[:1])
+    expected = (inputs[:1] - params.mean) / np.sqrt(params.var + 1e-5)
+    assert np.allclose(expected, out, atol=1e-6)
+
+
+@pytest.mark.parametrize('opt', [optimizers.Adam(.1), optimizers.Lamb(.1),
+                                 optimizers.Partitioned(optimizers.Adam(.1),
+                                                        {'batch_norm/gamma': None})])
+def test_BatchNorm_running_statistics_without_optimizer_state(opt):
+    inputs = random_inputs((4, 3))
+    batch_norm = BatchNorm(axis=(0,), momentum=.5)
+
+    @parametrized
+    def loss(inputs):
+        return np.sum(batch_norm(inputs) ** 2)
+
+    params = loss.init_parameters(inputs, key=PRNGKey(0))
+    updated = updated_parameters(loss.apply, params, inputs)
+    assert updated.batch_norm.mean and updated.batch_norm.var
+    assert not updated.batch_norm.beta and not updated.batch_norm.gamma
+
+    state = opt.init(params, updated)
+    values = state.values.values if isinstance(opt, optimizers.Partitioned) else state.values
+    assert 1 == len(values.batch_norm.mean) == len(values.batch_norm.var)
+    state = opt.update(loss.apply, state, inputs, jit=True)
+    state = opt.update(loss.apply, state, inputs, jit=True)
+    params = opt.get_parameters(state).batch_norm
+    mean, var = np.mean(inputs, 0), np.var(inputs, 0)
+    assert np.allclose(.75 * mean, params.mean)
+    assert np.allclose(.25 + .75 * var, params.var)
+
+
+def test_BatchNorm_running_statistics_cast():
+    inputs = random_inputs((4, 3))
+    batch_norm = BatchNorm(axis=(0,), momentum=.5)
+
+    def loss(params, inputs):
+        params, inputs = tree_map(lambda x: x.astype(np.float16), (params, inputs))
+        return np.sum(batch_norm.apply(params, inputs)).astype(np.float32)
+
+    params = batch_norm.init_parameters(inputs, key=PRNGKey(0))
+    opt = optimizers.Sgd(0.)
+    params = opt.get_parameters(opt.update(loss, opt.init(params), inputs))
+    assert np.float32 == params.mean.dtype
+    assert np.allclose(.5 * np.mean(inputs, 0), params.mean, atol=1e-3)
+
+
+def test_BatchNorm_running_statistics_raises_within_jit():
+    inputs = random_inputs((4, 3))
+    batch_norm = BatchNorm(axis=(0,), momentum=.5)
+    params = batch_norm.init_parameters(inputs, key=PRNGKey(0))
+    opt = optimizers.Sgd(0.)
+
+    def loss(params, inputs):
+        return np.sum(batch_norm.apply(params, inputs, jit=True))
+
+    with raises(ValueError):
+        opt.update(loss, opt.init(params), inputs)
+
+
+def test_BatchNorm_running_statistics_skipped_step():
+    batch_norm = BatchNorm(axis=(0,), momentum=.5)
+
+    def loss(params, inputs):
+        return np.sum(batch_norm.apply(params, inputs))
+
+    inputs = np.full((2, 3), 1e38)
+    params = batch_norm.init_parameters(inputs, key=PRNGKey(0))
+    opt = optimizers.LossScaled(optimizers.Sgd(.1))
+    state = opt.update(loss, opt.init(params), inputs, jit=True)
+    assert 1 == opt.get_skipped_steps(state)
+    assert_parameters_equal(params, opt.get_parameters(state))
+
+
+@pytest.mark.parametrize('nested', (False, True))
+def test_fold_batch_norm(nested):
+    def Net(test_mode):
+        net = Sequential(Conv(3, (2, 2)), BatchNorm(momentum=.9, test_mode=test_mode), relu,
+                         flatten, Dense(4), BatchNorm(axis=(0,), momentum=.9, test_mode=test_mode))
+        return Sequential(net, relu) if nested else net
+
+    inputs = random_inputs((2, 5, 5, 2))
+    net = Net(test_mode=False)
+    params = net.init_parameters(inputs, key=PRNGKey(0))
+    sequential = params.sequential if nested else params
+    sequential = sequential._replace(
+        batch_norm0=sequential.batch_norm0._replace(mean=random_inputs((3,)),
+                                                    var=np.exp(random_inputs((3,)))),
+        batch_norm1=sequential.batch_norm1._replace(mean=random_inputs((4,)),
+                                                    var=np.exp(random_inputs((4,)))))
+    params = params._replace(sequential=sequential) if nested else sequential
+
+    out = fold_batch_norm(net, params)(inputs)
+    assert np.allclose(Net(test_mode=True).apply(params, inputs), out, atol=1e-5)
+
+
+def test_fold_batch_norm_layers_calling_parametrized():
+    def Net(test_mode):
+        inner = Sequential(Conv(3, (2, 2)), BatchNorm(momentum=.9, test_mode=test_mode), relu)
+        return Sequential(Conv(2, (1, 1)), BatchNorm(momentum=.9, test_mode=test_mode),
+                          lambda x: inner(x) + 1, flatten)
+
+    inputs = random_inputs((2, 5, 5, 2))
+    net = Net(test_mode=False)
+    params = net.init_parameters(inputs, key=PRNGKey(0))
+    inner = params.sequential
+    params = params._replace(
+        batch_norm=params.batch_norm._replace(mean=random_inputs((2,)),
+                                              var=np.exp(random_inputs((2,)))),
+        sequential=inner._replace(batch_norm=inner.batch_norm._replace(
+            mean=random_inputs((3,)), var=np.exp(random_inputs((3,))))))
+
+    with pytest.warns(UserWarning, match='not folded'):
+        out = fold_batch_norm(net, params)(inputs)
+
+    assert np.allclose(Net(test_mode=True).apply(params, inputs), out, atol=1e-5)
+
+
 def test_Sequential_graceful_update_message():
     message = 'Call like Sequential(Dense(10), relu), without "[" and "]". ' \
               '(Or pass iterables with Sequential(*layers).)'
@@ -322,3 +626,25 @@ def test_Batched():
     assert_parameters_equal((unbatched_params,), params)
     out_batched = dense.apply(params, np.ones((batch_size, 2)))
     assert np.array_equal(out_batched_, out_batched)
+
+
+@pytest.mark.parametrize('share_inputs', (True, False))
+@pytest.mark.parametrize('average', (True, False))
+def test_Ensemble(share_inputs, average):
+    n = 3
+    model = Sequential(Dense(4), relu, Dense(2))
+    ensemble = Ensemble(model, n, share_inputs=share_inputs, average=average)
+    inputs = np.ones((5, 3)) if share_inputs else random_inputs((n, 5, 3))
+    params = ensemble.init_parameters(inputs, key=PRNGKey(0))
+    assert (n, 3, 4) == params.model.dense0.kernel.shape
+    assert not np.allclose(params.model.dense0.kernel[0], params.model.dense0.kernel[1])
+
+    out = ensemble.apply(params, inputs)
+    assert ((5, 2) if average else (n, 5, 2)) == out.shape
+
+    outs = np.stack([model.apply(tree_map(lambda x: x[i], params.model),
+                                 inputs if share_inputs else inputs[i]) for i in range(n)])
+    assert np.allclose(np.mean(outs, axis=0) if average else outs, out, atol=1e-6)
+
+    out_ = ensemble.apply(params, inputs, jit=True)
+    assert np.allclose(out, out_)
@@ -1,12 +1,15 @@
 from pathlib import Path
 
 import pytest
+from jax import partial, random, tree_map, tree_multimap, value_and_grad
 from jax.nn import relu, log_softmax
+from jax.nn.initializers import ones, zeros, normal
 from jax.random import PRNGKey
+from jax.tree_util import tree_leaves
 
 from jaxnet import *
 from jaxnet.optimizers import *
-from tests.util import enable_checks
+from tests.util import enable_checks, assert_parameters_equal
 
 enable_checks()
 
@@ -22,7 +25,11 @@ def loss_without_parameters(inputs, targets):
 
 
 @pytest.mark.parametrize('jit', (False, True))
-@pytest.mark.parametrize('opt', (Sgd(), Momentum(.1, .1), Adagrad(), RmsProp(.1), Adam(), Sm3(.1)))
+@pytest.mark.parametrize('opt', (Sgd(), Momentum(.1, .1), Adagrad(), RmsProp(.1), Adam(), Sm3(.1),
+                                 Adafactor(), Adafactor(.1, beta1=.9, factored_minimum_size=2),
+                                 Adam(moment_dtype=np.bfloat16), Adam(moment_dtype=np.int8),
+                                 Lars(.1), Lamb(per_module=True, weight_decay=.01),
+                                 LossScaled(Adam()), Fused(Adam()), Averaged(Adam())))
 @pytest.mark.parametrize('loss', (loss_with_parameters, loss_without_parameters))
 def test(loss, jit, opt):
     def next_batch():
@@ -60,3 +67,543 @@ def test(loss, jit, opt):
     state = load(path)
 
     check()
+
+
+def test_LossScaled():
+    @parametrized
+    def loss(inputs):
+        return np.sum(parameter((2,), ones) * inputs)
+
+    inputs = np.ones(2)
+    params = loss.init_parameters(inputs, key=PRNGKey(0))
+    opt = LossScaled(Sgd(), initial_scale=2. ** 4, growth_interval=2)
+    state = opt.init(params)
+
+    state = opt.update(loss.apply, state, inputs)
+    sgd = Sgd()
+    sgd_state = sgd.update(loss.apply, sgd.init(params), inputs)
+    assert np.allclose(sgd.get_parameters(sgd_state).parameter,
+                       opt.get_parameters(state).parameter)
+    assert 2. ** 4 == opt.get_scale(state)
+
+    state, l = opt.update_and_get_loss(loss.apply, state, inputs, jit=True)
+    assert 2 == opt.get_step(state)
+    assert np.allclose(2 * .99, l)
+    assert 2. ** 5 == opt.get_scale(state)
+
+    overflowing_inputs = np.full(2, 1e38)
+    parameters = opt.get_parameters(state)
+    state = opt.update(loss.apply, state, overflowing_inputs, jit=True)
+    assert 2 == opt.get_step(state)
+    assert 1 == opt.get_skipped_steps(state)
+    assert 2. ** 4 == opt.get_scale(state)
+    assert np.array_equal(parameters.parameter, opt.get_parameters(state).parameter)
+
+
+@pytest.mark.parametrize('opt', (Sgd(), Momentum(.1, .1), Adam()))
+def test_Fused(opt):
+    inputs, targets = np.ones((3, 10)), np.ones((3, 4))
+    params = loss_with_parameters.init_parameters(inputs, targets, key=PRNGKey(0))
+    fused = Fused(opt)
+    fused_state = fused.init(params)
+    assert 1 == len(fused_state.values)
+    assert_parameters_equal(params, fused.get_parameters(fused_state))
+
+    state = opt.init(params)
+    for _ in range(2):
+        state = opt.update(loss_with_parameters.apply, state, inputs, targets)
+        fused_state = fused.update(loss_with_parameters.apply, fused_state, inputs, targets,
+                                   jit=True)
+
+    for p, p_ in zip(tree_leaves(opt.get_parameters(state)),
+                     tree_leaves(fused.get_parameters(fused_state))):
+        assert np.allclose(p, p_)
+
+
+@pytest.mark.parametrize('opt', (Sm3(.1), Adafactor(), Lamb(), Lars(.1), LossScaled(Sgd()),
+                                 Fused(Sgd()), Vectorized(Lamb, step_size=np.ones(2))))
+def test_Fused_raises_for_non_elementwise(opt):
+    with pytest.raises(ValueError):
+        Fused(opt)
+
+
+def test_get_parameters_dict():
+    @parametrized
+    def loss(inputs):
+        return np.sum(parameter((2,), ones) * inputs)
+
+    opt = Adam()
+    params = {'a': np.ones(2), 'b': [np.zeros(3), np.zeros(())]}
+    state = opt.init(params)
+    assert_parameters_equal(params, opt.get_parameters(state))
+
+    state = opt.update(lambda p, x: loss.apply(p['a'], x) + np.sum(p['b'][0]), state, np.ones(2),
+                       jit=True)
+    params = opt.get_parameters(state)
+    assert isinstance(params, dict)
+    assert (3,) == params['b'][0].shape
+
+
+def test_get_parameters_of_loaded_state():
+    params = loss_with_parameters.init_parameters(np.zeros((3, 10)), np.zeros((3, 4)),
+                                                  key=PRNGKey(0))
+    state = Adam().init(params)
+    assert_parameters_equal(params, Adam().get_parameters(state))
+
+
+def test_get_parameters_of_loaded_dict_state():
+    params = {'a': np.ones(2), 'b': [np.zeros(3), {'c': np.zeros(())}]}
+    state = Adam().init(params)
+
+    path = Path('/') / 'tmp' / 'dict.state'
+    save(state, path)
+    assert_parameters_equal(params, Adam().get_parameters(load(path)))
+
+
+def test_init_without_calling_super_init():
+    class Identity(Optimizer):
+        def __init__(self):
+            pass
+
+        def _init_for_parameter(self, parameter):
+            return Sgd.ParameterState(parameter)
+
+        def _update_for_parameter(self, step, gradient, state):
+            return state
+
+        def _get_parameter(self, state):
+            parameter, = state
+            return parameter
+
+    params = {'a': np.ones(2)}
+    assert_parameters_equal(params, Identity().get_parameters(Identity().init(params)))
+
+
+def test_Adafactor_factored():
+    inputs, targets = np.ones((3, 10)), np.ones((3, 4))
+    params = loss_with_parameters.init_parameters(inputs, targets, key=PRNGKey(0))
+    opt = Adafactor(factored_minimum_size=4)
+    state = opt.init(params)
+    state = opt.update(loss_with_parameters.apply, state, inputs, targets, jit=True)
+
+    kernel_state = state.values.sequential.dense0.kernel
+    assert ('parameter', 'v_row', 'v_col') == kernel_state._fields
+    assert (10,) == kernel_state.v_row.shape
+    assert (4,) == kernel_state.v_col.shape
+    assert ('parameter', 'v') == state.values.sequential.dense0.bias._fields
+    assert (10, 4) == opt.get_parameters(state).sequential.dense0.kernel.shape
+
+
+@pytest.mark.parametrize('moment_dtype', (np.int8, np.bfloat16))
+@pytest.mark.parametrize('Opt', (partial(Momentum, .1, .9), partial(RmsProp, .01), Adam))
+def test_low_precision_moments(Opt, moment_dtype):
+    inputs, targets = np.ones((3, 10)), np.ones((3, 4))
+    params = loss_with_parameters.init_parameters(inputs, targets, key=PRNGKey(0))
+    opt, reference = Opt(moment_dtype=moment_dtype), Opt()
+    state, reference_state = opt.init(params), reference.init(params)
+    for _ in range(3):
+        state = opt.update(loss_with_parameters.apply, state, inputs, targets, jit=True)
+        reference_state = reference.update(loss_with_parameters.apply, reference_state, inputs,
+                                           targets, jit=True)
+
+    kernel_state = state.values.sequential.dense0.kernel
+    assert np.float32 == kernel_state.parameter.dtype
+    for moment in kernel_state[1:]:
+        assert moment_dtype == (moment.values.dtype if moment_dtype == np.int8 else moment.dtype)
+
+    for p, p_ in zip(tree_leaves(opt.get_parameters(state)),
+                     tree_leaves(reference.get_parameters(reference_state))):
+        assert np.allclose(p, p_, atol=1e-3)
+
+
+@pytest.mark.parametrize('Opt', (partial(RmsProp, .01), Adam))
+def test_low_precision_moments_high_dynamic_range(Opt):
+    @parametrized
+    def loss(inputs):
+        return np.sum(parameter((4,), zeros) * inputs)
+
+    step_size = .01
+    opt = Opt(step_size=step_size, moment_dtype=np.int8)
+    state = opt.init(loss.init_parameters(np.ones(4), key=PRNGKey(0)))
+    # gradients spanning orders of magnitude within one block, where the largest oscillates:
+    for sign in (1, -1, 1, -1):
+        state = opt.update(loss.apply, state, np.array([sign * 1e3, 1., 1e-2, 1e-4]), jit=True)
+
+    assert np.all(np.abs(opt.get_parameters(state).parameter) < 4 * 10 * step_size)
+
+
+@pytest.mark.parametrize('opt', (Sgd(), Adam(), LossScaled(Momentum(.1, .9))))
+def test_update_many(opt):
+    inputs, targets = random.normal(PRNGKey(0), (10, 10)), np.ones((10, 4))
+    params = loss_with_parameters.init_parameters(inputs, targets, key=PRNGKey(0))
+    state = opt.init(params)
+
+    state, losses = opt.update_many(loss_with_parameters.apply, state, (inputs, targets),
+                                    num_steps=7, batch_size=3, key=PRNGKey(0))
+    assert 7 == opt.get_step(state)
+    assert (7,) == losses.shape
+    assert (10, 4) == opt.get_parameters(state).sequential.dense0.kernel.shape
+
+    full_batch_state = opt.init(params)
+    for _ in range(2):
+        full_batch_state = opt.update(loss_with_parameters.apply, full_batch_state, inputs,
+                                      targets)
+    state, _ = opt.update_many(loss_with_parameters.apply, opt.init(params), (inputs, targets),
+                               num_steps=2, batch_size=10, key=PRNGKey(1))
+    for p, p_ in zip(tree_leaves(opt.get_parameters(full_batch_state)),
+                     tree_leaves(opt.get_parameters(state))):
+        assert np.allclose(p, p_, atol=1e-6)
+
+
+def test_update_many_randomized():
+    @parametrized
+    def loss(inputs):
+        return np.mean(Dropout(.5)(Dense(2)(inputs)))
+
+    inputs = np.ones((4, 3))
+    opt = Sgd()
+    state = opt.init(loss.init_parameters(inputs, key=PRNGKey(0)))
+    state, losses = opt.update_many(loss.apply, state, (inputs,), num_steps=4, batch_size=4,
+                                    key=PRNGKey(0), randomized=True)
+    assert 4 == opt.get_step(state)
+    assert len(set(map(float, losses))) > 1
+
+
+@pytest.mark.parametrize('jit', (False, True))
+def test_microbatches(jit):
+    inputs, targets = random.normal(PRNGKey(0), (6, 10)), np.ones((6, 4))
+    params = loss_with_parameters.init_parameters(inputs, targets, key=PRNGKey(0))
+    opt = Adam()
+
+    state, loss = opt.update_and_get_loss(loss_with_parameters.apply, opt.init(params),
+                                          inputs, targets, jit=jit)
+    state_, loss_ = opt.update_and_get_loss(loss_with_parameters.apply, opt.init(params),
+                                            inputs, targets, jit=jit, microbatches=3)
+    assert np.allclose(loss, loss_)
+    assert 1 == opt.get_step(state_)
+    for p, p_ in zip(tree_leaves(opt.get_parameters(state)),
+                     tree_leaves(opt.get_parameters(state_))):
+        assert np.allclose(p, p_, atol=1e-6)
+
+    with pytest.raises(ValueError):
+        opt.update(loss_with_parameters.apply, opt.init(params), inputs, targets, microbatches=4)
+
+
+def test_microbatches_randomized():
+    @parametrized
+    def loss(inputs):
+        return np.mean(Dropout(.5)(Dense(2)(inputs)))
+
+    inputs = np.ones((4, 3))
+    opt = Sgd()
+    state = opt.init(loss.init_parameters(inputs, key=PRNGKey(0)))
+    state = opt.update(loss.apply, state, inputs, key=PRNGKey(0), microbatches=2, jit=True)
+    assert 1 == opt.get_step(state)
+
+
+def test_GradientTransformed():
+    @parametrized
+    def loss(inputs):
+        return np.sum(parameter((2,), ones) * inputs)
+
+    inputs = np.array([3., 4.])
+    params = loss.init_parameters(inputs, key=PRNGKey(0))
+
+    def trained_parameter(*transforms, jit=False):
+        opt = GradientTransformed(Sgd(1.), *transforms)
+        state = opt.update(loss.apply, opt.init(params), inputs, jit=jit)
+        assert 1 == opt.get_step(state)
+        return opt.get_parameters(state).parameter
+
+    assert np.allclose(np.array([-2., -3.]), trained_parameter())
+    assert np.allclose(np.array([1 - .6, 1 - .8]), trained_parameter(clip_by_global_norm(1.)))
+    assert np.allclose(np.array([1 - .6, 1 - .8]), trained_parameter(clip_by_norm(1.), jit=True))
+    assert np.allclose(np.array([-2.5, -3.5]), trained_parameter(l2_penalty(.5)))
+    assert np.allclose(np.array([1 - .6 - .5, 1 - .8 - .5]),
+                       trained_parameter(clip_by_global_norm(1.), l2_penalty(.5)))
+
+
+@pytest.mark.parametrize('opt', (Sgd(.1), Adam(.1), Fused(Adam(.1))))
+def test_GradientTransformed_parameter_decay(opt):
+    inputs, targets = np.ones((3, 10)), np.ones((3, 4))
+    params = loss_with_parameters.init_parameters(inputs, targets, key=PRNGKey(0))
+    decoupled = GradientTransformed(opt, clip_by_global_norm(1.), parameter_decay=.1 * .5)
+    coupled = GradientTransformed(opt, clip_by_global_norm(1.))
+    state = decoupled.update(loss_with_parameters.apply, decoupled.init(params), inputs, targets,
+                             jit=True)
+    coupled_state = coupled.update(loss_with_parameters.apply, coupled.init(params), inputs,
+                                   targets)
+
+    for p, p_, p__ in zip(tree_leaves(params), tree_leaves(decoupled.get_parameters(state)),
+                          tree_leaves(coupled.get_parameters(coupled_state))):
+        assert np.allclose(p__ - .1 * .5 * p, p_, atol=1e-6)
+
+
+def test_gradient_centralization():
+    gradients = {'kernel': np.array([[1., 2.], [3., 6.]]), 'bias': np.array([1., 2.])}
+    centralized = gradient_centralization()(gradients, None)
+    assert np.allclose(np.array([[-1., -2.], [1., 2.]]), centralized['kernel'])
+    assert np.array_equal(gradients['bias'], centralized['bias'])
+
+
+@pytest.mark.parametrize('opt', (Sgd(.1, weight_decay=.5), Momentum(.1, .9, weight_decay=.5),
+                                 Adam(.1, weight_decay=.5)))
+def test_weight_decay(opt):
+    @parametrized
+    def loss(inputs):
+        return np.sum(parameter((2,), ones)) * inputs
+
+    zero = np.zeros(())
+    state = opt.init(loss.init_parameters(zero, key=PRNGKey(0)))
+    state = opt.update(loss.apply, state, zero, jit=True)
+    assert np.allclose(np.full(2, 1 - .1 * .5), opt.get_parameters(state).parameter)
+
+
+@pytest.mark.parametrize('jit', (False, True))
+def test_Averaged(jit):
+    @parametrized
+    def loss(inputs):
+        return np.sum(parameter((2,), ones) * inputs)
+
+    inputs = np.ones(2)
+    params = loss.init_parameters(inputs, key=PRNGKey(0))
+
+    def averaged_parameters(opt, steps):
+        state = opt.init(params)
+        for _ in range(steps):
+            state = opt.update(loss.apply, state, inputs, jit=jit)
+
+        assert np.allclose(np.full(2, 1. - steps), opt.get_parameters(state).parameter)
+        return opt.get_parameters(state, averaged=True).parameter
+
+    assert np.allclose(np.zeros(2), averaged_parameters(Averaged(Sgd(1.), decay=.5), 1))
+    assert np.allclose(np.full(2, -2 / 3), averaged_parameters(Averaged(Sgd(1.), decay=.5), 2))
+    assert np.allclose(np.full(2, .5),
+                       averaged_parameters(Averaged(Sgd(1.), decay=.5, bias_correction=False), 1))
+
+    opt = Averaged(Sgd(1.), decay=.5, start_step=1)
+    assert np.allclose(np.zeros(2), averaged_parameters(opt, 1))
+    assert np.allclose(np.full(2, -1.), averaged_parameters(opt, 2))
+    assert np.allclose(np.full(2, -5 / 3), averaged_parameters(opt, 3))
+
+
+@pytest.mark.parametrize('per_module', (False, True))
+@pytest.mark.parametrize('jit', (False, True))
+def test_Lamb_trust_ratio(per_module, jit):
+    @parametrized
+    def loss(x, y):
+        a = parameter((2,), lambda key, shape: np.array([3., 4.]), 'a')
+        b = parameter((2,), zeros, 'b')
+        return np.sum(a * x) + np.sum(b * y)
+
+    x, y = np.array([1., 0.]), np.array([0., 1.])
+    opt = Lamb(.1, exclude_vectors=False, per_module=per_module)
+    state = opt.init(loss.init_parameters(x, y, key=PRNGKey(0)))
+    state = opt.update(loss.apply, state, x, y, jit=jit)
+    params = opt.get_parameters(state)
+
+    a_ratio, b_ratio = (5 / np.sqrt(2), 5 / np.sqrt(2)) if per_module else (5, 1)
+    assert np.allclose(np.array([3. - .1 * a_ratio, 4.]), params.a, atol=1e-5)
+    assert np.allclose(np.array([0., -.1 * b_ratio]), params.b, atol=1e-5)
+
+
+def test_Lars_excludes_vectors():
+    inputs, targets = np.ones((3, 10)), np.ones((3, 4))
+    params = loss_with_parameters.init_parameters(inputs, targets, key=PRNGKey(0))
+    opt, sgd = Lars(.1, momentum=0.), Sgd(.1)
+    state = opt.update(loss_with_parameters.apply, opt.init(params), inputs, targets)
+    sgd_state = sgd.update(loss_with_parameters.apply, sgd.init(params), inputs, targets)
+
+    bias, sgd_bias = (o.get_parameters(s).sequential.dense0.bias
+                      for o, s in ((opt, state), (sgd, sgd_state)))
+    kernel, sgd_kernel = (o.get_parameters(s).sequential.dense0.kernel
+                          for o, s in ((opt, state), (sgd, sgd_state)))
+    assert np.allclose(sgd_bias, bias)
+    assert not np.allclose(sgd_kernel, kernel)
+
+
+@pytest.mark.parametrize('jit', (False, True))
+@pytest.mark.parametrize('microbatches', (1, 3))
+def test_Partitioned(jit, microbatches):
+    inputs, targets = np.ones((3, 10)), np.ones((3, 4))
+    params = loss_with_parameters.init_parameters(inputs, targets, key=PRNGKey(0))
+    opt = Partitioned(Sgd(.1), {'sequential/dense0': None,
+                                ('sequential', 'dense1', 'bias'): Sgd(0.)})
+    state = opt.init(params)
+    frozen, _ = state.values.partitions
+    assert_parameters_equal(params.sequential.dense0, frozen)
+    assert state.values.values.sequential.dense0 is None
+
+    state = opt.update(loss_with_parameters.apply, state, inputs, targets, jit=jit,
+                       microbatches=microbatches)
+    trained = opt.get_parameters(state)
+    assert 1 == opt.get_step(state)
+    assert_parameters_equal(params.sequential.dense0, trained.sequential.dense0)
+    assert np.array_equal(params.sequential.dense1.bias, trained.sequential.dense1.bias)
+    assert not np.allclose(params.sequential.dense1.kernel, trained.sequential.dense1.kernel)
+
+
+def test_Partitioned_by_module():
+    frozen_layer = Dense(4)
+    net = Sequential(frozen_layer, relu, Dense(4))
+
+    @parametrized
+    def loss(inputs, targets):
+        return -np.mean(net(inputs) * targets)
+
+    inputs, targets = np.ones((3, 10)), np.ones((3, 4))
+    params = loss.init_parameters(inputs, targets, key=PRNGKey(0))
+    opt = Partitioned(Adam(), {frozen_layer: None}, model=loss.shaped(inputs, targets))
+    assert (('sequential', 'dense0'),) == opt.paths
+
+    state = opt.update(loss.apply, opt.init(params), inputs, targets)
+    trained = opt.get_parameters(state)
+    assert_parameters_equal(params.sequential.dense0, trained.sequential.dense0)
+    assert not np.allclose(params.sequential.dense1.kernel, trained.sequential.dense1.kernel)
+
+    with pytest.raises(ValueError):
+        Partitioned(Adam(), {frozen_layer: None})
+
+
+@pytest.mark.parametrize('transforms,parameter_decay', (((), .1), ((l2_penalty(.5),), 0.)))
+def test_GradientTransformed_Partitioned(transforms, parameter_decay):
+    inputs, targets = np.ones((3, 10)), np.ones((3, 4))
+    params = loss_with_parameters.init_parameters(inputs, targets, key=PRNGKey(0))
+    opt = GradientTransformed(Partitioned(Adam(.1), {'sequential/dense0': None}), *transforms,
+                              parameter_decay=parameter_decay)
+    state = opt.update(loss_with_parameters.apply, opt.init(params), inputs, targets, jit=True)
+    trained = opt.get_parameters(state)
+    assert_parameters_equal(params.sequential.dense0, trained.sequential.dense0)
+    assert not np.allclose(params.sequential.dense1.kernel, trained.sequential.dense1.kernel)
+
+
+@pytest.mark.parametrize('jit', (False, True))
+def test_Vectorized(jit):
+    inputs, targets = np.ones((3, 10)), np.ones((3, 4))
+    replicas = 3
+    params = loss_with_parameters.init_parameters(inputs, targets,
+                                                  key=random.split(PRNGKey(0), replicas))
+    step_sizes = np.array([0., .1, .2])
+    opt = Vectorized(Adam, step_size=step_sizes, b1=.5)
+    state = opt.init(params)
+    state, losses = opt.update_and_get_loss(loss_with_parameters.apply, state, inputs, targets,
+                                            jit=jit)
+    assert (replicas,) == losses.shape
+    assert 1 == opt.get_step(state)
+    trained = opt.get_parameters(state)
+    assert (replicas, 10, 4) == trained.sequential.dense0.kernel.shape
+
+    for i, step_size in enumerate(step_sizes):
+        replica_params = tree_map(lambda x: x[i], params)
+        replica_opt = Adam(step_size, b1=.5)
+        replica_state, loss = replica_opt.update_and_get_loss(
+            loss_with_parameters.apply, replica_opt.init(replica_params), inputs, targets)
+        assert np.allclose(loss, losses[i])
+        for p, p_ in zip(tree_leaves(replica_opt.get_parameters(replica_state)),
+                         tree_leaves(trained)):
+            assert np.allclose(p, p_[i], atol=1e-6)
+
+
+def test_update_truncated():
+    cell, carry_init, input_projection = FusedGRUCell(3, normal())
+    rnn = Rnn(cell, carry_init, input_projection, return_carry=True)
+
+    @parametrized
+    def loss(carry, inputs, targets):
+        outputs, carry = rnn(inputs, carry)
+        return np.mean((outputs - targets) ** 2), carry
+
+    inputs = random.normal(PRNGKey(0), (2, 6, 4))
+    targets = random.normal(PRNGKey(1), (2, 6, 3))
+    carry = carry_init(2)
+    params = loss.init_parameters(carry, inputs[:, :2], targets[:, :2], key=PRNGKey(2))
+    opt = Sgd(.1)
+    state, final_carry, losses = opt.update_truncated(loss.apply, opt.init(params), carry,
+                                                      (inputs, targets), window=2)
+    assert (3,) == losses.shape
+    assert 3 == opt.get_step(state)
+
+    expected_params = params
+    for i, start in enumerate(range(0, 6, 2)):
+        (expected_loss, carry), gradients = value_and_grad(loss.apply, has_aux=True)(
+            expected_params, carry, inputs[:, start:start + 2], targets[:, start:start + 2])
+        expected_params = tree_multimap(lambda p, g: p - .1 * g, expected_params, gradients)
+        assert np.allclose(expected_loss, losses[i], atol=1e-6)
+
+    assert np.allclose(carry, final_carry, atol=1e-6)
+    for p, p_ in zip(tree_leaves(expected_params), tree_leaves(opt.get_parameters(state))):
+        assert np.allclose(p, p_, atol=1e-6)
+
+    opt = LossScaled(Adam())
+    state, _, losses = opt.update_truncated(loss.apply, opt.init(params), carry_init(2),
+                                            (inputs, targets), window=3)
+    assert (2,) == losses.shape
+
+    with pytest.raises(ValueError):
+        opt.update_truncated(loss.apply, state, carry_init(2), (inputs, targets), window=4)
+
+
+@pytest.mark.parametrize('microbatches', (1, 2))
+def test_update_truncated_running_statistics(microbatches):
+    cell, carry_init, input_projection = FusedGRUCell(3, normal())
+    rnn = Rnn(cell, carry_init, input_projection, return_carry=True)
+    batch_norm = BatchNorm(axis=(0, 1), momentum=.5)
+
+    @parametrized
+    def loss(carry, inputs, targets):
+        outputs, carry = rnn(batch_norm(inputs), carry)
+        return np.mean((outputs - targets) ** 2), carry
+
+    inputs = random.normal(PRNGKey(0), (2, 6, 4))
+    targets = random.normal(PRNGKey(1), (2, 6, 3))
+    params = loss.init_parameters(carry_init(2), inputs[:, :2], targets[:, :2], key=PRNGKey(2))
+    opt = Sgd(.1)
+    state, final_carry, losses = opt.update_truncated(
+        loss.apply, opt.init(params), carry_init(2), (inputs, targets), window=2,
+        microbatches=microbatches)
+    assert (3,) == losses.shape
+    assert (2, 3) == final_carry.shape
+
+    expected_mean = np.zeros(4)
+    for start in range(0, 6, 2):
+        expected_mean = .5 * expected_mean + .5 * np.mean(inputs[:, start:start + 2], (0, 1))
+
+    assert np.allclose(expected_mean, opt.get_parameters(state).batch_norm.mean, atol=1e-6)
+
+
+def test_Vectorized_shared_hyperparameters():
+    inputs, targets = np.ones((3, 10)), np.ones((3, 4))
+    replicas = 2
+    params = loss_with_parameters.init_parameters(inputs, targets,
+                                                  key=random.split(PRNGKey(0), replicas))
+    opt = Vectorized(Adam, step_size=exponential_decay(.1, 1, .5), b1=np.array([.5, .9]),
+                     moment_dtype=np.float16)
+    state = opt.update(loss_with_parameters.apply, opt.init(params), inputs, targets, jit=True)
+    trained = opt.get_parameters(state)
+
+    for i, b1 in enumerate((.5, .9)):
+        replica_opt = Adam(exponential_decay(.1, 1, .5), b1=b1, moment_dtype=np.float16)
+        replica_state = replica_opt.update(loss_with_parameters.apply,
+                                           replica_opt.init(tree_map(lambda x: x[i], params)),
+                                           inputs, targets)
+        for p, p_ in zip(tree_leaves(replica_opt.get_parameters(replica_state)),
+                         tree_leaves(trained)):
+            assert np.allclose(p, p_[i], atol=1e-6)
+
+
+def test_Fused_Vectorized():
+    inputs, targets = np.ones((3, 10)), np.ones((3, 4))
+    replicas = 3
+    params = loss_with_parameters.init_parameters(inputs, targets,
+                                                  key=random.split(PRNGKey(0), replicas))
+    opt = Vectorized(Adam, step_size=np.array([0., .1, .2]))
+    fused = Fused(Vectorized(Adam, step_size=np.array([0., .1, .2])))
+    fused_state = fused.init(params)
+    assert 1 == len(fused_state.values)
+    assert_parameters_equal(params, fused.get_parameters(fused_state))
+
+    state = opt.update(loss_with_parameters.apply, opt.init(params), inputs, targets)
+    fused_state = fused.update(loss_with_parameters.apply, fused_state, inputs, targets, jit=True)
+    for p, p_ in zip(tree_leaves(opt.get_parameters(state)),
+                     tree_leaves(fused.get_parameters(fused_state))):
+        assert np.allclose(p, p_, atol=1e-6)